@@ -0,0 +1,63 @@
+# /bin/python3
+# Benchmarks for rendering hot paths. Run from same directory as config.json, like tests.py.
+import math
+import random
+import time
+
+import render
+import utils
+
+
+def make_ring(points: int, lat: float = 58.5, lon: float = 25.0, radius: float = 1.0):
+    # Wobbly ring of given size, roughly shaped like country border: large bays and
+    # headlands, smaller wiggles along them and some noise at the scale of node spacing.
+    ring = []
+    for i in range(points):
+        angle = 2 * math.pi * i / points
+        r = radius * (1 + 0.08 * math.sin(7 * angle) + 0.02 * math.sin(97 * angle) + 0.0002 * random.random())
+        ring.append((lat + r * 0.5 * math.sin(angle), lon + r * math.cos(angle)))
+    ring.append(ring[0])
+    return ring
+
+
+def bench_projection(points: int = 10000) -> None:
+    # Per-point path is slow mostly because of print2 calls, so keep point count moderate.
+    frag = (7, 58.5, 25.0)
+    tile_range = render.get_image_tile_range(frag[1], frag[2], frag[0])
+    segment = make_ring(points)
+
+    t = time.perf_counter()
+    per_point = [utils.wgs2pixel(point, tile_range, frag) for point in segment]
+    per_point_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    batch = utils.wgs2pixel_batch(segment, tile_range, frag)
+    batch_time = time.perf_counter() - t
+
+    assert [tuple(point) for point in batch.tolist()] == per_point
+    print(f"Projection of {len(segment)} points:")
+    print(f"  per point (wgs2pixel):    {round(per_point_time * 1000, 1)} ms")
+    print(f"  batch (wgs2pixel_batch):  {round(batch_time * 1000, 1)} ms")
+    print(f"  speedup:                  {round(per_point_time / batch_time)}x")
+
+
+def bench_simplification(points: int = 50000) -> None:
+    for zoom in (5, 7, 9):
+        frag = (zoom, 58.5, 25.0)
+        tile_range = render.get_image_tile_range(frag[1], frag[2], frag[0])
+        segments = render.project_segments([make_ring(points)], tile_range, frag)
+
+        t = time.perf_counter()
+        reduced = render.reduce_segment_nodes(segments)
+        simplify_time = time.perf_counter() - t
+
+        print(f"Simplification at zoom {zoom}:")
+        print(f"  original:                 {len(segments[0])} points")
+        print(f"  stride (calc_limit):      {render.RenderSegment.calc_limit(len(segments[0])) + 1} points")
+        print(f"  reduce_segment_nodes:     {len(reduced[0])} points in {round(simplify_time * 1000, 1)} ms")
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    bench_projection()
+    bench_simplification()
@@ -0,0 +1,81 @@
+# /bin/python3
+# In-memory caches for downloaded data. Used by network module, but kept separate
+# as there is nothing network-specific in here.
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Callable
+from typing import Hashable
+from typing import Optional
+
+
+class LRUCache:
+    # Least recently used entries are thrown out first, when cache grows over max_size entries
+    # or, if sizeof function is given, over max_bytes. Each entry can have it's own time-to-live.
+    def __init__(
+        self,
+        max_size: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Optional[Callable[[Any], int]] = None,
+    ):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        # Sum of sizes of all entries, only meaningful when sizeof is set.
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Key -> (expiry timestamp or None, size, value). Most recently used entries are at the end.
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires, size, value = entry
+        if expires is not None and expires < time.time():
+            self.pop(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        # ttl is in seconds, None means that entry is only removed by eviction.
+        self.pop(key)
+        size = self.sizeof(value) if self.sizeof else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # Would push everything else out and still not fit.
+        expires = time.time() + ttl if ttl is not None else None
+        self._data[key] = (expires, size, value)
+        self.bytes += size
+        self._evict()
+
+    def pop(self, key: Hashable) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.bytes = 0
+
+    def _evict(self) -> None:
+        while (self.max_size is not None and len(self._data) > self.max_size) or (
+            self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            key, (expires, size, value) = self._data.popitem(last=False)
+            self.bytes -= size
+
+    def __contains__(self, key: Hashable) -> bool:
+        # Doesn't count as hit or miss.
+        entry = self._data.get(key)
+        return entry is not None and (entry[0] is None or entry[0] >= time.time())
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {len(self._data)} entries"
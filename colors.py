@@ -3,7 +3,7 @@
 import colorsys
 import json
 
-import requests
+import aiohttp
 
 from configuration import config
 
@@ -12,10 +12,15 @@ RAL_url = config["rendering"]["RAL_url"]
 # colnames_url="https://raw.githubusercontent.com/bahamas10/css-color-names/master/css-color-names.json"
 # RAL_url="https://raw.githubusercontent.com/smaddy/ral-json/main/ral_pretty.json"
 
+# Both are filled by load_colours, once shared HTTP session is available.
+colours = dict()
+RAL = dict()
 
-def get_RAL():
+
+async def get_RAL(session: aiohttp.ClientSession):
     RAL = dict()
-    data = requests.get(RAL_url).json()
+    async with session.get(RAL_url) as res:
+        data = await res.json(content_type=None)
     for code in data:
         for name in data[code]["names"]:
             col = "".join(data[code]["names"][name].lower().split())
@@ -28,20 +33,25 @@ def get_RAL():
     return RAL
 
 
-colours = requests.get(colnames_url).json()
-RAL = get_RAL()
+async def load_colours(session: aiohttp.ClientSession) -> None:
+    # Downloads colour name lists. Called from on_ready with the shared session.
+    global colours, RAL
+    async with session.get(colnames_url) as res:
+        colours = await res.json(content_type=None)
+    RAL = await get_RAL(session)
+
+    custom_colours = {  # The most common color tags not covered by algorithm of try_parse_colour
+        # Mostly these are foreign names of css colours.
+        "grau": colours["gray"],
+        "rot": colours["red"],
+        "rouge": colours["red"],
+        "braun": colours["brown"],
+        "marfim": RAL["ivory"],
+        "sand": RAL["sandyellow"],
+    }
+    colours.update(custom_colours)
 
 
-custom_colours = {  # The most common color tags not covered by algorithm of try_parse_colour
-    # Mostly these are foreign names of css colours.
-    "grau": colours["gray"],
-    "rot": colours["red"],
-    "rouge": colours["red"],
-    "braun": colours["brown"],
-    "marfim": RAL["ivory"],
-    "sand": RAL["sandyellow"],
-}
-colours.update(custom_colours)
 # There are 365 (of 1870) named colours listed on taginfo, 100 of them are default css color codes.
 
 
@@ -17,10 +17,7 @@ from typing import Iterable
 from typing import Union
 from urllib.parse import quote
 
-import aiohttp
 import discord
-import overpy
-import requests
 from discord import AllowedMentions
 from discord import Client
 from discord import Embed
@@ -42,6 +39,7 @@ from dotenv import load_dotenv
 from PIL import Image
 from PIL import ImageDraw  # For drawing elements
 
+import colors
 import network
 import regexes
 import render
@@ -51,14 +49,10 @@ from configuration import guild_ids
 from utils import *  # Backup for cases when utils.* prefix was not added yet.
 
 ## SETUP ##
-# This global set contains filename similar to /googlebad. If on_message fails, it will remove cached files on next run.
-cached_files: set = set()
 # Set of unix timestamps.
 recent_googles: set = set()
 
 
-overpass_api = overpy.Overpass(url=config["overpass_url"])
-
 INSPECT_EMOJI = config["emoji"]["inspect"]  # :mag_right:
 IMAGE_EMOJI = config["emoji"]["image"]  # :frame_photo:
 EMBEDDED_EMOJI = config["emoji"]["embedded"]  # :bed:
@@ -75,7 +69,17 @@ with open(config["ohno_file"], "r", encoding="utf8") as file:
 with open(config["josm_tips_file"], "r", encoding="utf8") as file:
     josm_tips = [entry for entry in file.read().split("\n\n") if entry != ""]
 
-client = commands.Bot(
+
+class OSMBot(commands.Bot):
+    async def close(self) -> None:
+        # Shared HTTP session and element store live as long as the bot does.
+        await network.flush_username_cache()
+        await network.close_session()
+        await network.close_element_store()
+        await super().close()
+
+
+client = OSMBot(
     intents=Intents.all(),
     command_prefix="?",
     allowed_mentions=AllowedMentions(
@@ -95,6 +99,15 @@ slash = SlashCommand(client, sync_commands=True)
 @client.event  # type: ignore
 async def on_ready() -> None:
     print(f"{client.user} is connected to the following guilds:\n")
+    # One HTTP session with connection pooling is shared by all modules doing network I/O.
+    # on_ready may run again after reconnecting, so resources are only loaded once.
+    session = await network.get_session()
+    if not colors.colours:
+        await colors.load_colours(session)
+    if render.open_note_icon is None:
+        await render.load_icons(session)
+    network.start_tile_eviction()
+    network.start_username_flush()
     for guild in client.guilds:
         try:
             # Update member count when bot starts up
@@ -173,23 +186,25 @@ async def taginfo_command(ctx: SlashContext, tag: str) -> None:
 
     if len(split_tag) == 1:
         await ctx.defer()
-        await ctx.send(embed=taginfo_embed(split_tag[0]))
+        await ctx.send(embed=await taginfo_embed(split_tag[0]))
     elif len(split_tag) == 2:
         await ctx.defer()
-        await ctx.send(embed=taginfo_embed(split_tag[0], split_tag[1]))
+        await ctx.send(embed=await taginfo_embed(split_tag[0], split_tag[1]))
     else:
         await ctx.send("Please provide a tag.", hidden=True)
 
 
-def taginfo_embed(key: str, value: str | None = None) -> Embed:
+async def taginfo_embed(key: str, value: str | None = None) -> Embed:
     if value:
-        data = requests.get(config["taginfo_url"] + f"api/4/tag/stats?key={quote(key)}&value={quote(value)}").json()
-        data_wiki = requests.get(
+        data = await network.get_json(
+            config["taginfo_url"] + f"api/4/tag/stats?key={quote(key)}&value={quote(value)}"
+        )
+        data_wiki = await network.get_json(
             config["taginfo_url"] + f"api/4/tag/wiki_pages?key={quote(key)}&value={quote(value)}"
-        ).json()
+        )
     else:
-        data = requests.get(config["taginfo_url"] + f"api/4/key/stats?key={quote(key)}").json()
-        data_wiki = requests.get(config["taginfo_url"] + f"api/4/key/wiki_pages?key={quote(key)}").json()
+        data = await network.get_json(config["taginfo_url"] + f"api/4/key/stats?key={quote(key)}")
+        data_wiki = await network.get_json(config["taginfo_url"] + f"api/4/key/wiki_pages?key={quote(key)}")
 
     data_wiki_en_list = [lang for lang in data_wiki["data"] if lang["lang"] == "en"]
     data_wiki_en = data_wiki_en_list[0] if data_wiki_en_list else None
@@ -304,7 +319,7 @@ async def elm_command(ctx: SlashContext, elm_type: str, elm_id: str, extras: str
         return
 
     try:
-        elm = network.get_elm(elm_type, elm_id)
+        elm = await network.get_elm(elm_type, elm_id)
     except ValueError as error_message:
         utils.print2(error_message, lvl=3)
         await ctx.send(error_message, hidden=True)
@@ -312,20 +327,17 @@ async def elm_command(ctx: SlashContext, elm_type: str, elm_id: str, extras: str
     files = []
     if "map" in extras_list:
         await ctx.defer()
-        render_queue = await elms_to_render(elm_type, elm_id)
+        render_queue = await render.elms_to_render(elm_type, elm_id)
         utils.check_rate_limit(ctx.author_id, extra=len(render_queue) ** config["rate_limit"]["rendering_rate_exp"])
-        bbox = get_render_queue_bounds(render_queue)
-        zoom, lat, lon = calc_preview_area(bbox)
-        cluster, filename, errors = await get_image_cluster(lat, lon, zoom)
-        cached_files.add(filename)
-        cluster, filename2 = render_elms_on_cluster(cluster, render_queue, (zoom, lat, lon))
-        cached_files.add(filename2)
+        bbox = render.get_render_queue_bounds(render_queue)
+        zoom, lat, lon = render.calc_preview_area(bbox)
+        cluster, errors, degraded = await get_image_cluster(lat, lon, zoom)
+        cluster = await utils.run_in_executor(render.render_elms_on_cluster, cluster, render_queue, (zoom, lat, lon))
     embed = elm_embed(elm, extras_list)
     file = None
     if "map" in extras_list:
-        utils.print2("attachment://" + filename2.split("/")[-1], lvl=1)
-        embed.set_image(url="attachment://" + filename2.split("/")[-1])
-        file = File(filename2)
+        file = await image_to_file(cluster)
+        embed.set_image(url="attachment://" + file.filename)
     await ctx.send(embed=embed, file=file)
 
 
@@ -490,7 +502,7 @@ async def changeset_command(ctx: SlashContext, changeset_id: str, extras: str =
             return
 
     try:
-        changeset = network.get_elm("changeset", changeset_id, "discussion" in extras)
+        changeset = await network.get_elm("changeset", changeset_id, "discussion" in extras)
     except ValueError as error_message:
         await ctx.send(error_message, hidden=True)
         return
@@ -500,18 +512,15 @@ async def changeset_command(ctx: SlashContext, changeset_id: str, extras: str =
         await ctx.defer()
         render_queue = changeset["geometry"]
         utils.check_rate_limit(ctx.author_id)
-        bbox = get_render_queue_bounds(render_queue)
-        zoom, lat, lon = calc_preview_area(bbox)
-        cluster, filename, errors = await get_image_cluster(lat, lon, zoom)
-        cached_files.add(filename)
-        cluster, filename2 = render_elms_on_cluster(cluster, render_queue, (zoom, lat, lon))
-        cached_files.add(filename2)
+        bbox = render.get_render_queue_bounds(render_queue)
+        zoom, lat, lon = render.calc_preview_area(bbox)
+        cluster, errors, degraded = await get_image_cluster(lat, lon, zoom)
+        cluster = await utils.run_in_executor(render.render_elms_on_cluster, cluster, render_queue, (zoom, lat, lon))
     embed = changeset_embed(changeset, extras_list)
     file = None
     if "map" in extras_list:
-        utils.print2("attachment://" + filename2.split("/")[-1], lvl=1)
-        embed.set_image(url="attachment://" + filename2.split("/")[-1])
-        file = File(filename2)
+        file = await image_to_file(cluster)
+        embed.set_image(url="attachment://" + file.filename)
     await ctx.send(embed=embed, file=file)
 
 
@@ -622,7 +631,7 @@ async def note_command(ctx: SlashContext, note_id: str, extras: str = "") -> Non
             return
 
     try:
-        note = network.get_elm("note", note_id)
+        note = await network.get_elm("note", note_id)
     except ValueError as error_message:
         await ctx.send(error_message, hidden=True)
         return
@@ -724,10 +733,9 @@ async def user_command(ctx: SlashContext, username: str, extras: str = "") -> No
             return
 
     try:
-        # Both will raise ValueError if the user isn't found, network.get_id_from_username will usually error first.
+        # Raises ValueError if the user isn't found, username lookup will usually error first.
         # In cases where the account was only removed recently, getting user will error.
-        user_id = network.get_id_from_username(username)
-        user = network.get_elm("user", user_id)
+        user = await network.get_user(username)
     except ValueError as error_message:
         await ctx.send(error_message, hidden=True)
         return
@@ -810,159 +818,49 @@ async def showmap_command(ctx: SlashContext, url: str) -> None:
     first_msg = await ctx.send("Getting image…")
     with ctx.channel.typing():
 
-        image_file, filename, errorlog = await get_image_cluster(lat_deg, lon_deg, zoom_int)
+        file, errorlog = await get_map_fragment(lat_deg, lon_deg, zoom_int)
 
         # TODO: I probabbly need to get some better injection protection at some point.
         # This works though so eh ¯\_(ツ)_/¯
         msg = f"<{config['site_url']}#map={zoom_int}/{lat_deg}/{lon_deg}>"
 
-        img_msg = await ctx.channel.send(msg, file=File(filename))
+        img_msg = await ctx.channel.send(msg, file=file)
 
     await first_msg.edit(
         content=f'Getting image… Done[!](<{utils.msg_to_link(img_msg)}> "Link to message with image") :map:'
     )
 
 
-async def elms_to_render(
-    elem_type,
-    elem_id,
-    no_reduction=False,
-    get_bbox=False,
-    recursion_depth=0,
-    status_msg: Message | None = None,
-):
-    # Inputs:   elem_type (node / way / relation)
-    #           elem_id     element's OSM ID as string
-    # Queries OSM element geometry via overpass API.
-    # Example: elms_to_render('relation', '60189')  (Russia)
-    # To be tested with relation 908054 - Public transport network of Sofia.
-    # Possible alternative approach to rendering by creating very rough drawing on bot-side.
-    # Using overpass to query just geometry.
-    # And then draw just very few nodes onto map retrieved by showmap
-    # Even easier alternative is drawing bounding box
-    # Throws IndexError if element was not found
-    # Needs handling for Overpass's over quota error.
-    # Future improvement possibility: include tags into output to control rendering, especially colours.
-    # I have currently odd bug that when get_bbox is fixed to True, all following queries also have bbox.
-
-    get_center = False
-    if elem_type != "relation":
-        get_bbox = False
-    elif 1 < recursion_depth:
-        get_center = True
-    if get_bbox:
-        output_type = "bb"
-    elif get_center:
-        output_type = "center"
-    else:
-        output_type = "skel geom"  # Original version
-    Q = "[out:json][timeout:45];" + elem_type + "(id:" + str(elem_id) + ");out " + output_type + ";"
-    if status_msg:
-        await status_msg.edit(
-            content=f"{LOADING_EMOJI} Querying `" + Q + "`"
-        )  # I hope this works. uncomment on live instance
-    # Above line may introduce error when running it from /element, not on_message.
-    try:
-        result = overpass_api.query(Q)
-    except exception.OverpassRuntimeError:
-        print("Overpass timeout")
-        if not get_bbox:
-            # recursion_depth is not increased, because this is retry of same element
-            return await elms_to_render(elem_type, elem_id, no_reduction, True, recursion_depth, status_msg=status_msg)
-        else:
-            Q = Q.replace("bb;", "skel center;")
-            get_center = True
-            if status_msg:
-                await status_msg.edit(content=f"{LOADING_EMOJI} Querying `" + Q + "`")
-            result = overpass_api.query(Q)
-    # return result
-    # Since we are querying for single element, top level result will have just 1 element.
-    node_count = 0
-    # Combining all queries together is much faster
-    # Let's say that maximum recursion depth can be 2 levels (EU > Belgium > Counties; Sofia network > Bus line > Bus stops)
-    if get_center:
-        if "center" in result.relations[0].attributes:
-            center = result.relations[0].attributes["center"]
-            return [[(float(center["lat"]), float(center["lon"]))]]
-    elif get_bbox:
-        if "bounds" in result.relations[0].attributes:
-            bound = result.relations[0].attributes["bounds"]
-            # {'minlat': Decimal('59.4'), 'minlon': Decimal('24.6'), 'maxlat': Decimal('59.5'), 'maxlon': Decimal('24.7')
-            return [
-                [
-                    (float(bound["minlat"]), float(bound["minlon"])),
-                    (float(bound["minlat"]), float(bound["maxlon"])),
-                    (float(bound["maxlat"]), float(bound["maxlon"])),
-                    (float(bound["maxlat"]), float(bound["minlon"])),
-                    (float(bound["minlat"]), float(bound["minlon"])),
-                ]
-            ]
-    if elem_type == "relation":
-        segments = []
-        elems = result.relations[0].members
-        prev_last = None
-        for i in range(len(elems)):
-            # Previously it skipped elements based on role, but it was buggy.
-            # New, recursive approach.
-            if type(elems[i]) == overpy.RelationRelation:
-                seg = await elms_to_render(
-                    "relation", elems[i].ref, True, get_bbox, recursion_depth + 1, status_msg=status_msg
-                )
-                segments += seg
-            elif type(elems[i]) == overpy.RelationNode:  # Single node as member of relation
-                segments.append([(float(elems[i].attributes["lat"]), float(elems[i].attributes["lon"]))])
-            elif type(elems[i]) == overpy.RelationWay:
-                geom = elems[i].geometry
-                segments.append(list(map(lambda x: (float(x.lat), float(x.lon)), geom)))
-    elif elem_type == "way":
-        elems = result.ways[0]
-        segments = [
-            list(map(lambda x: (float(x.lat), float(x.lon)), elems.get_nodes(True)))
-        ]  # True means resolving node references.
-    elif elem_type == "node":
-        # Creates simply a single-node segment.
-        segments = [[(float(result.nodes[0].lat), float(result.nodes[0].lon))]]
-    else:  # If encountered unknown element type.
-        return []
-    if no_reduction:
-        return segments
-    # segments=merge_segments(segments)
-    segments = render.reduce_segment_nodes(segments)
-    # We now have list of lists of (lat, lon) coordinates to be rendered.
-    # These lists of segments can be joined, if multiple elements are requested
-    # In order to add support for colours, just create segment-colour pairs.
-    return segments
-
-
 async def _get_image_cluster__get_image(
-    session: aiohttp.ClientSession,
-    cluster: Image,
     zoom: int,
     tile_url: str,
     xtile: int,
     ytile: int,
     xtile_corrected: int,
     tile_range: tuple,
-) -> None | tuple[str, str, Exception]:
-    url = tile_url.format(zoom=zoom, x=xtile_corrected, y=ytile)
-    utils.print2(f"Requesting: {url}", lvl=4)
+    deadline: float,
+) -> tuple[None | tuple[Image, tuple[int, int]], None | tuple[str, str, Exception], bool]:
+    # Returns tile with its position on map fragment, or error. Last value tells if tile is
+    # only a blurry substitute for the real one.
+    position = utils.tile2pixel((xtile, ytile), zoom, tile_range)
     try:
-        res = await session.get(url, headers=config["rendering"]["HEADERS"])
-        data = await res.content.read()
-        cluster.paste(
-            Image.open(BytesIO(data)),
-            utils.tile2pixel((xtile, ytile), zoom, tile_range),
-        )
-        return None
+        return (await network.get_tile(tile_url, zoom, xtile_corrected, ytile, deadline), position), None, False
     except Exception as e:
         utils.print2(e, lvl=4)
-        return ("map tile", url, e)
+        # Blurry tile is better than black hole in the map.
+        tile = network.get_overzoomed_tile(tile_url, zoom, xtile_corrected, ytile)
+        if tile is not None:
+            utils.print2(f"Using overzoomed tile for {zoom}/{xtile_corrected}/{ytile}", lvl=2)
+            return (tile, position), None, True
+        tile_name = network.tile_templates(tile_url)[0].format(zoom=zoom, x=xtile_corrected, y=ytile)
+        return None, ("map tile", tile_name, e), True
 
 
 async def get_image_cluster(
     lat_deg: float, lon_deg: float, zoom: int, tile_url: str = config["tile_url"]
-) -> tuple[Any, str, list[tuple[str, str, Exception]]]:
+) -> tuple[Any, list[tuple[str, str, Exception]], bool]:
     # Rewrite of https://github.com/ForgottenHero/mr-maps
+    # Returns map fragment, errors and whether any tiles are missing or substituted.
     # Following line is duplicataed at calc_preview_area()
     n: int = 2 ** zoom  # N is number of tiles in one direction on zoom level
 
@@ -970,48 +868,82 @@ async def get_image_cluster(
     # xmin, xmax, ymin, ymax, tile_offset
     tile_range = render.get_image_tile_range(lat_deg, lon_deg, zoom)
     utils.print2(tile_range, lvl=3)
-    xmin, xmax, ymin, ymax, tile_offset = tile_range
-
-    errorlog = []
-    cluster = Image.new(
-        "RGB",
-        (
-            config["rendering"]["tiles_x"] * config["rendering"]["tile_w"] - 1,
-            config["rendering"]["tiles_y"] * config["rendering"]["tile_h"] - 1,
-        ),
-    )
 
     t = time.time()
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for xtile in range(xmin - 1, xmax + 2):
-            utils.print2(xtile, xtile % n, lvl=4)
-            xtile_corrected = xtile % n  # Repeats tiles across -180/180 meridian.
-            # Xtile is preserved, because it's used for plotting tile on image cluster,
-            # While xtile_corrected value is by N smaller and used for requesting tile from web.
-            for ytile in range(max([0, ymin]), min([ymax + 2, n])):
-                tasks.append(
-                    _get_image_cluster__get_image(
-                        session,
-                        cluster,
-                        zoom,
-                        tile_url,
-                        xtile,
-                        ytile,
-                        xtile_corrected,
-                        tile_range,
-                    )
-                )
-        errors = await asyncio.gather(*tasks, return_exceptions=True)
+    # Tiles that aren't downloaded by then are left out, rather than keeping user waiting.
+    deadline = t + config["rendering"]["render_deadline"]
+    tasks = []
+    for xtile, ytile in render.get_visible_tiles(zoom, tile_range):
+        xtile_corrected = xtile % n  # Repeats tiles across -180/180 meridian.
+        # Xtile is preserved, because it's used for plotting tile on image cluster,
+        # While xtile_corrected value is by N smaller and used for requesting tile from web.
+        tasks.append(
+            _get_image_cluster__get_image(
+                zoom,
+                tile_url,
+                xtile,
+                ytile,
+                xtile_corrected,
+                tile_range,
+                deadline,
+            )
+        )
+    results = await asyncio.gather(*tasks)
+    tiles = [tile for tile, error, degraded in results if tile is not None]
+    errorlog = [error for tile, error, degraded in results if error is not None]
+    degraded = any(degraded for tile, error, degraded in results)
+    utils.print2(f"Download: {round(time.time()-t, 1)}s", lvl=1)
 
-        for err in errors:
-            if err is not None:
-                errorlog.append(err)
+    # Stitching takes long enough to block other commands, if done in event loop.
+    t = time.time()
+    cluster = await utils.run_in_executor(render.stitch_tiles, tiles)
+    utils.print2(f"Paste: {round(time.time()-t, 1)}s", lvl=1)
+    return cluster, errorlog, degraded
 
-    utils.print2(f"Download + paste: {round(time.time()-t, 1)}s", lvl=1)
-    filename: str = config["map_save_file"].format(t=time.time())
-    cluster.save(filename)
-    return cluster, filename, errorlog
+
+async def encode_for_upload(image: Image) -> bytes:
+    output_format = config["rendering"]["output"]["format"]
+    data, seconds = await utils.run_in_executor(render.encode_image, image, output_format)
+    render.record_encode(output_format, seconds, len(data))
+    return data
+
+
+def bytes_to_file(data: bytes, name: str = "map") -> File:
+    # Each request gets it's own buffer, nothing is written to disk.
+    output_format = config["rendering"]["output"]["format"]
+    return File(BytesIO(data), filename=f"{name}.{render.output_extensions.get(output_format, 'png')}")
+
+
+async def image_to_file(image: Image, name: str = "map") -> File:
+    return bytes_to_file(await encode_for_upload(image), name)
+
+
+async def get_map_fragment(
+    lat_deg: float, lon_deg: float, zoom: int, tile_url: str = config["tile_url"]
+) -> tuple[File, list[tuple[str, str, Exception]]]:
+    # Map fragment without any elements drawn on it. Finished fragments are cached, so that
+    # posting same (or almost same) #map= link again needs neither tiles nor encoding.
+    key = render.fragment_key(lat_deg, lon_deg, zoom, tile_url)
+    lat_deg, lon_deg = render.snap_to_fragment_grid(lat_deg, lon_deg, zoom)
+    data = render.fragment_cache.get(key)
+    if data is not None:
+        utils.print2("Fragment cache:", render.fragment_cache.stats(), lvl=2)
+        return bytes_to_file(data), []
+    # Same fragment requested concurrently (e.g. twice in one message) is rendered once.
+    data, errorlog = await network.single_flight(
+        ("fragment", key), _get_map_fragment__render, key, lat_deg, lon_deg, zoom, tile_url
+    )
+    return bytes_to_file(data), errorlog
+
+
+async def _get_map_fragment__render(
+    key: tuple, lat_deg: float, lon_deg: float, zoom: int, tile_url: str
+) -> tuple[bytes, list[tuple[str, str, Exception]]]:
+    cluster, errorlog, degraded = await get_image_cluster(lat_deg, lon_deg, zoom, tile_url)
+    data = await encode_for_upload(cluster)
+    if not degraded:  # Incomplete or blurry map would be served again after tile server recovers.
+        render.fragment_cache.set(key, data, config["cache"]["fragments_ttl"])
+    return data, errorlog
 
 
 element_action_row = manage_components.create_actionrow(
@@ -1092,10 +1024,17 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
             #         await msg.delete()
 
 
+async def _on_message__get_map_fragment(
+    map_frag: str, limiter: asyncio.Semaphore
+) -> tuple[File, list[tuple[str, str, Exception]]]:
+    async with limiter:
+        utils.print2(f"\n\nProcessing {map_frag}.", lvl=2)
+        zoom, lat, lon = utils.frag_to_bits(map_frag)
+        return await get_map_fragment(lat, lon, zoom)
+
+
 @client.event  # type: ignore
 async def on_message(msg: Message) -> None:
-    global cached_files
-
     if msg.author == client.user:
         return
 
@@ -1168,14 +1107,29 @@ async def on_message(msg: Message) -> None:
         files: list[File] = []
         errorlog = []
 
+        if add_embedded and elms:
+            # All elements of one type are downloaded with single request.
+            await status_msg.edit(content=f"{LOADING_EMOJI} Downloading elements.")
+            elm_ids_by_type: dict[str, list[str]] = {}
+            for elm_type, elm_ids, separator in elms:
+                elm_ids_by_type.setdefault(elm_type, []).extend(elm_ids)
+            downloaded_elms = dict(
+                zip(
+                    elm_ids_by_type,
+                    await asyncio.gather(*(network.get_elms(t, ids) for t, ids in elm_ids_by_type.items())),
+                )
+            )
         for elm_type, elm_ids, separator in elms:
             for elm_id in elm_ids:
                 await status_msg.edit(content=f"{LOADING_EMOJI} Processing {elm_type}/{elm_id}.")
                 try:
                     if add_embedded:
-                        embeds.append(elm_embed(network.get_elm(elm_type, elm_id)))
+                        elm = downloaded_elms[elm_type][elm_id]
+                        if isinstance(elm, ValueError):
+                            raise elm
+                        embeds.append(elm_embed(elm))
                     if add_image:
-                        render_queue += await elms_to_render(elm_type, elm_id, status_msg=status_msg)
+                        render_queue += await render.elms_to_render(elm_type, elm_id, status_msg=status_msg)
                 except ValueError as error_message:
                     errorlog.append((elm_type, elm_id, error_message))
 
@@ -1184,7 +1138,7 @@ async def on_message(msg: Message) -> None:
             for changeset_id in changeset_ids:
                 await status_msg.edit(content=f"{LOADING_EMOJI} Processing {elm_type}/{changeset_id}.")
                 try:
-                    changeset = network.get_elm("changeset", changeset_id)
+                    changeset = await network.get_elm("changeset", changeset_id)
                     if add_embedded:
                         embeds.append(changeset_embed(changeset))
                     if add_image:
@@ -1198,7 +1152,7 @@ async def on_message(msg: Message) -> None:
             for note_id in note_ids:
                 await status_msg.edit(content=f"{LOADING_EMOJI} Processing {elm_type}/{note_id}.")
                 try:
-                    note = network.get_elm("note", note_id)
+                    note = await network.get_elm("note", note_id)
                     if add_embedded:
                         embeds.append(note_embed(note))
                     if add_image:
@@ -1226,47 +1180,48 @@ async def on_message(msg: Message) -> None:
             # Next step is to calculate map area for render.
             await status_msg.edit(content=f"{LOADING_EMOJI} Downloading map tiles")
             bbox = render.get_render_queue_bounds(render_queue, notes_render_queue)
-            zoom, lat, lon = calc_preview_area(bbox)
+            zoom, lat, lon = render.calc_preview_area(bbox)
             if notes_render_queue:
                 zoom = min([zoom, config["rendering"]["max_note_zoom"]])
             utils.print2(zoom, lat, lon, sep="/", lvl=2)
-            cluster, filename, errors = await get_image_cluster(lat, lon, zoom)
-            cached_files.add(filename)
+            cluster, errors, degraded = await get_image_cluster(lat, lon, zoom)
             errorlog += errors
 
             # Start drawing elements on image.
             if render_queue:
                 await status_msg.edit(content=f"{LOADING_EMOJI} Rendering elements to map.")
-                cluster, filename2 = render_elms_on_cluster(cluster, render_queue, (zoom, lat, lon))
-                cached_files.add(filename2)
-            else:
-                filename2 = filename
+                cluster = await utils.run_in_executor(
+                    render.render_elms_on_cluster, cluster, render_queue, (zoom, lat, lon)
+                )
             if notes_render_queue:
                 await status_msg.edit(content=f"{LOADING_EMOJI} Rendering notes to map.")
-                for note in notes_render_queue:
-                    cluster, filename2 = render_notes_on_cluster(
-                        cluster, notes_render_queue, (zoom, lat, lon), filename2
-                    )
-                cached_files.add(filename2)
-            files.append(File(filename2))
+                cluster = await utils.run_in_executor(
+                    render.render_notes_on_cluster,
+                    cluster,
+                    notes_render_queue,
+                    (zoom, lat, lon),
+                    (render.open_note_icon, render.closed_note_icon),
+                )
+            files.append(await image_to_file(cluster))
 
         for elm_type, usernames, separator in users:
             # note_ids = (<tuple: list of notes>, <str: separator used>)
             for username in usernames:
                 await status_msg.edit(content=f"{LOADING_EMOJI} Processing user/{username}.")
                 try:
-                    embeds.append(user_embed(network.get_elm("user", network.get_id_from_username(username))))
+                    embeds.append(user_embed(await network.get_user(username)))
                 except ValueError as error_message:
                     errorlog.append(("user", username, error_message))
 
-        for map_frag in map_frags:
-            await status_msg.edit(content=f"{LOADING_EMOJI} Processing {map_frag}.")
-            utils.print2(f"\n\nProcessing {map_frag}.", lvl=2)
-            zoom, lat, lon = utils.frag_to_bits(map_frag)
-            cluster, filename, errors = await get_image_cluster(lat, lon, zoom)
-            errorlog += errors
-            files.append(File(filename))
-            cached_files.add(filename)
+        if map_frags:
+            await status_msg.edit(content=f"{LOADING_EMOJI} Processing {len(map_frags)} map fragment(s).")
+            # Fragments are rendered concurrently, gather keeps them in original order.
+            frag_limiter = asyncio.Semaphore(config["rendering"]["max_parallel_fragments"])
+            for file, errors in await asyncio.gather(
+                *(_on_message__get_map_fragment(map_frag, frag_limiter) for map_frag in map_frags)
+            ):
+                errorlog += errors
+                files.append(file)
         await status_msg.edit(content=f"{LOADING_EMOJI} Starting upload")
         # Send the messages
         if len(embeds) > 0:
@@ -1299,11 +1254,6 @@ async def on_message(msg: Message) -> None:
             utils.check_rate_limit(author_id, time_spent)
         utils.print2(f"Script spent {time_spent} sec on preparing output (render, embeds, files, errors).", 1)
 
-    # Clean up files
-    for filename in cached_files:
-        os.remove(filename)
-    cached_files = set()
-
 
 ### Member count ###
 @client.event  # type: ignore
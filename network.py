@@ -1,15 +1,758 @@
 # /bin/python3
 # Functions used for communicating with network services. Mainly getting elements
 # and maybe later servicing tiles and overpass queries (+caching) as well.
+import asyncio
+import copy
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from io import BytesIO
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
 from typing import Union
+from urllib.parse import urlparse
 
-import requests
+import aiohttp
+import overpy
+from PIL import Image
 
+import cache
+import utils
 from configuration import config
 from configuration import guild_ids
 
+# Process-wide HTTP session shared by OSM API, taginfo, Overpass, tile and other downloads.
+# Keeping one session means that connections (and TLS handshakes) are reused between requests.
+# Opened by get_session() (first time in on_ready) and closed by close_session() on shutdown.
+session: Optional[aiohttp.ClientSession] = None
+# overpy is only used for parsing Overpass responses, because it's own query() uses blocking urllib.
+overpass_parser = overpy.Overpass(url=config["overpass_url"])
+# Upstream requests currently in progress, keyed by URL or Overpass query. See single_flight.
+in_flight: Dict[Hashable, asyncio.Future] = dict()
+# Maximum number of IDs in one multi-fetch request, keeps URLs reasonably short.
+MULTI_FETCH_LIMIT = 100
+# Username -> {"uid", "display_name", "time"} or {"uid": None, "error", "time"} for users that were not found.
+# Stored in config["cache"]["usernames_file"] to survive restarts.
+username_cache: Dict[str, dict] = dict()
+# Set when username_cache has changes that are not on disk yet, see flush_username_cache.
+username_cache_dirty = False
+username_flush_lock = asyncio.Lock()
+# Background task that writes username_cache to disk, see start_username_flush.
+username_flush_task: Optional[asyncio.Task] = None
+# (tile URL template, zoom, x, y) -> decoded tile, see get_tile.
+tile_cache = cache.LRUCache(max_bytes=config["cache"]["tiles_max_bytes"], sizeof=lambda tile: _image_size(tile))
+# Tile server host -> semaphore limiting concurrent requests to that host.
+tile_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+# Tile URL -> counter used to pick subdomain, see download_tile.
+tile_round_robin: Dict[str, Iterator[int]] = defaultdict(itertools.count)
+# Background task that keeps on-disk tile cache under size limit, see start_tile_eviction.
+tile_eviction_task: Optional[asyncio.Task] = None
+# URL -> {"body", "expires", "etag", "last_modified"} of cacheable responses, see _download.
+http_cache = cache.LRUCache(max_bytes=config["cache"]["http_max_bytes"], sizeof=lambda entry: len(entry["body"]))
 
-def get_elm(elm_type: str, elm_id: Union[int, str], get_discussion: bool = False) -> dict:
+
+async def get_session() -> aiohttp.ClientSession:
+    # Returns the shared session, creating it if needed (or if it has been closed).
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=config["network"]["max_connections"],
+            limit_per_host=config["network"]["max_connections_per_host"],
+            ttl_dns_cache=config["network"]["dns_cache_ttl"],
+            keepalive_timeout=config["network"]["keepalive_timeout"],
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"User-Agent": config["rendering"]["HEADERS"]["User-Agent"]},
+            timeout=aiohttp.ClientTimeout(total=config["network"]["timeout"]),
+        )
+    return session
+
+
+async def close_session() -> None:
+    global session
+    if session is not None and not session.closed:
+        await session.close()
+    session = None
+
+
+async def single_flight(key: Hashable, func: Callable[..., Awaitable], *args) -> Any:
+    # If identical request (same key) is already in progress, wait for it's result instead of starting a new one.
+    # Result is shared by all waiters, so it should not be modified by them.
+    future = in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(func(*args))
+        in_flight[key] = future
+        future.add_done_callback(lambda _: in_flight.pop(key, None))
+    # Shield keeps request running for others, even if one of the waiters is cancelled.
+    return await asyncio.shield(future)
+
+
+async def fetch(url: str, headers: Optional[dict] = None) -> Tuple[int, bytes]:
+    # All GET requests go through here, so that event loop is never blocked by waiting for a response
+    # and identical requests are coalesced. Returns status code and body of the response.
+    code, body, expires = await fetch_with_expiry(url, headers)
+    return code, body
+
+
+async def fetch_with_expiry(url: str, headers: Optional[dict] = None) -> Tuple[int, bytes, Optional[float]]:
+    # Same as fetch, but also returns timestamp until which response is fresh according to the server.
+    # Timestamp is None if the server didn't say (no Cache-Control max-age, no-cache, no-store nor Expires).
+    return await single_flight(("GET", url), _download, url, headers)
+
+
+async def _get(url: str) -> Tuple[int, str]:
+    code, body = await fetch(url)
+    return code, body.decode("utf-8")
+
+
+async def _download(url: str, headers: Optional[dict] = None) -> Tuple[int, bytes, Optional[float]]:
+    # Responses are kept in http_cache according to their Cache-Control/Expires headers.
+    # Stale responses with ETag or Last-Modified are revalidated with conditional request.
+    entry = http_cache.get(url)
+    if entry is not None and entry["expires"] > time.time():
+        return 200, entry["body"], entry["expires"] if entry["explicit"] else None
+    headers = dict(headers or {})
+    if entry is not None:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    session = await get_session()
+    async with session.get(url, headers=headers) as res:
+        code, body = res.status, await res.read()
+        response_headers = res.headers
+    if code == 304 and entry is not None:
+        utils.print2(f"Not modified: {url}", lvl=5)
+        entry["expires"] = time.time() + (_freshness_lifetime(response_headers) or 0)
+        entry["etag"] = response_headers.get("ETag", entry["etag"])
+        entry["explicit"] = _has_explicit_freshness(response_headers)
+        http_cache.set(url, entry)
+        return 200, entry["body"], entry["expires"] if entry["explicit"] else None
+    lifetime = _freshness_lifetime(response_headers)
+    expires = time.time() + (lifetime or 0)
+    explicit = _has_explicit_freshness(response_headers)
+    if code == 200:
+        etag, last_modified = response_headers.get("ETag"), response_headers.get("Last-Modified")
+        if lifetime is not None and (lifetime > 0 or etag or last_modified):
+            entry = {
+                "body": body,
+                "expires": expires,
+                "explicit": explicit,
+                "etag": etag,
+                "last_modified": last_modified,
+            }
+            http_cache.set(url, entry)
+    return code, body, expires if explicit else None
+
+
+def _has_explicit_freshness(headers) -> bool:
+    # Whether server said how long response is fresh, rather than _freshness_lifetime guessing it.
+    directives = headers.get("Cache-Control", "").lower().split(",")
+    cache_control = [directive.strip().partition("=")[0] for directive in directives]
+    return "Expires" in headers or any(name in cache_control for name in ("max-age", "no-cache", "no-store"))
+
+
+def _freshness_lifetime(headers) -> Optional[float]:
+    # How many seconds response can be used without asking the server again (RFC 7234).
+    # None means that response must not be stored at all.
+    cache_control = dict()
+    for directive in headers.get("Cache-Control", "").lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        cache_control[name] = value.strip('"')
+    if "no-store" in cache_control:
+        return None
+    if "no-cache" in cache_control:
+        return 0
+    age = float(headers.get("Age", 0) or 0)
+    if cache_control.get("max-age", "").isdigit():
+        return max(int(cache_control["max-age"]) - age, 0)
+    try:
+        if "Expires" in headers:
+            date = parsedate_to_datetime(headers["Date"]).timestamp() if "Date" in headers else time.time()
+            return max(parsedate_to_datetime(headers["Expires"]).timestamp() - date - age, 0)
+        if "Last-Modified" in headers:
+            # Heuristic freshness: 10% of the time since last modification, but not more than a day.
+            modified_ago = time.time() - parsedate_to_datetime(headers["Last-Modified"]).timestamp()
+            return min(max(modified_ago / 10, 0), 86400)
+    except (TypeError, ValueError):
+        pass  # Invalid date (e.g. Expires: 0) means already expired.
+    return 0
+
+
+def _image_size(image: Image.Image) -> int:
+    # Approximate memory used by decoded image.
+    return image.width * image.height * len(image.getbands())
+
+
+async def get_tile(tile_url: str, zoom: int, x: int, y: int, deadline: Optional[float] = None) -> Image.Image:
+    # Downloads and decodes map tile. Decoded tiles are kept in tile_cache, so that rendering
+    # same area again needs neither network requests nor PNG decoding. Cached tiles are
+    # shared, don't draw on them.
+    # Tiles that are not in memory are looked up from disk cache (if enabled) before downloading.
+    key = (tile_url, zoom, x, y)
+    tile = tile_cache.get(key)
+    if tile is None:
+        data = None
+        if config["cache"]["tiles_dir"]:
+            data = await asyncio.to_thread(_read_tile_file, tile_file_path(tile_url, zoom, x, y))
+        if data is None:
+            data, expires = await download_tile(tile_url, zoom, x, y, deadline)
+            if config["cache"]["tiles_dir"]:
+                if expires is None:
+                    # Some tile servers don't say how long tile is valid.
+                    expires = time.time() + config["cache"]["tiles_ttl"]
+                if expires > time.time():
+                    await asyncio.to_thread(_write_tile_file, tile_file_path(tile_url, zoom, x, y), data, expires)
+        tile = await utils.run_in_executor(_decode_tile, data)
+        tile_cache.set(key, tile, config["cache"]["tiles_ttl"])
+    utils.print2("Tile cache:", tile_cache.stats(), f"{tile_cache.bytes} bytes", lvl=5)
+    return tile
+
+
+def _decode_tile(data: bytes) -> Image.Image:
+    tile = Image.open(BytesIO(data))
+    tile.load()  # Image.open is lazy, decode now.
+    return tile
+
+
+def get_overzoomed_tile(tile_url: str, zoom: int, x: int, y: int) -> Optional[Image.Image]:
+    # Builds substitute for missing tile from lower zoom tile that is already in tile_cache,
+    # by cropping the part covering the tile and scaling it up. No requests are made.
+    for levels_up in range(1, min(zoom, config["cache"]["overzoom_levels"]) + 1):
+        scale = 2 ** levels_up
+        parent = tile_cache.get((tile_url, zoom - levels_up, x // scale, y // scale))
+        if parent is None:
+            continue
+        width, height = parent.width / scale, parent.height / scale
+        left, top = (x % scale) * width, (y % scale) * height
+        crop = parent.convert("RGB").crop((round(left), round(top), round(left + width), round(top + height)))
+        return crop.resize(parent.size, Image.BILINEAR)
+    return None
+
+
+def tile_templates(tile_url: str) -> List[str]:
+    # Tile URL may contain {s}, which is replaced with each of configured subdomains.
+    if "{s}" not in tile_url:
+        return [tile_url]
+    return [tile_url.replace("{s}", subdomain) for subdomain in config["network"]["tile_subdomains"]]
+
+
+def tile_host_semaphore(url: str) -> asyncio.Semaphore:
+    host = urlparse(url).netloc
+    if host not in tile_host_semaphores:
+        tile_host_semaphores[host] = asyncio.Semaphore(config["network"]["tile_connections_per_host"])
+    return tile_host_semaphores[host]
+
+
+async def download_tile(
+    tile_url: str, zoom: int, x: int, y: int, deadline: Optional[float] = None
+) -> Tuple[bytes, Optional[float]]:
+    # Requests are spread over subdomains in round-robin order and limited per host, as tile
+    # servers usually allow only few connections per client. Transient errors are retried with
+    # jittered backoff, but nothing is requested once deadline (timestamp) has passed.
+    templates = tile_templates(tile_url)
+    for attempt in range(config["network"]["tile_retries"] + 1):
+        template = templates[next(tile_round_robin[tile_url]) % len(templates)]
+        url = template.format(zoom=zoom, x=x, y=y)
+        async with tile_host_semaphore(url):
+            if deadline is not None and time.time() >= deadline:
+                raise ValueError("Render deadline passed before tile was downloaded.")
+            utils.print2(f"Requesting: {url}", lvl=4)
+            try:
+                remaining = deadline - time.time() if deadline is not None else None
+                code, data, expires = await asyncio.wait_for(
+                    fetch_with_expiry(url, headers=config["rendering"]["HEADERS"]), remaining
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = ValueError(f"Tile request failed: {e!r}")
+            else:
+                if code == 200:
+                    return data, expires
+                error = ValueError(f"Tile server responded with {code}.")
+                if code != 429 and code < 500:
+                    break  # Retrying wouldn't help.
+        delay = config["network"]["tile_retry_delay"] * 2 ** attempt * random.uniform(0.5, 1.5)
+        if attempt == config["network"]["tile_retries"] or (deadline is not None and time.time() + delay >= deadline):
+            break
+        await asyncio.sleep(delay)
+    raise error
+
+
+def tile_file_path(tile_url: str, zoom: int, x: int, y: int) -> str:
+    # Disk cache layout is {tiles_dir}/{tileset}/{zoom}/{x}/{y}.png, where tileset is made from
+    # tile URL template, so that different map styles don't mix. a/b/c subdomains share a tileset.
+    url = urlparse(tile_url)
+    tileset = re.sub(r"^([a-z]|\{s\})\.", "", url.netloc) + url.path.split("{zoom}")[0]
+    tileset = re.sub(r"[^\w.-]+", "_", tileset).strip("_")
+    return os.path.join(config["cache"]["tiles_dir"], tileset, str(zoom), str(x), f"{y}.png")
+
+
+def _read_tile_file(path: str) -> Optional[bytes]:
+    # File's modification time is used as expiry time of the tile.
+    try:
+        if os.path.getmtime(path) < time.time():
+            return None
+        with open(path, "rb") as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def _write_tile_file(path: str, data: bytes, expires: float) -> None:
+    # Tile is written under temporary name and then renamed, so that other workers
+    # sharing same directory never see half-written files.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.utime(temp_path, (time.time(), expires))
+        os.replace(temp_path, path)
+    except OSError as e:
+        utils.print2(f"Could not save tile {path}: {e}", lvl=2)
+
+
+def evict_tile_files() -> None:
+    # Keeps tile directory under configured size. Tiles that expire soonest are removed first.
+    files = []
+    total_size = 0
+    for root, dirs, filenames in os.walk(config["cache"]["tiles_dir"]):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Removed by another worker.
+            files.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+    max_size = config["cache"]["tiles_dir_max_gb"] * 1024 ** 3
+    if total_size <= max_size:
+        return
+    files.sort()
+    for expires, size, path in files:
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+        if total_size <= max_size:
+            break
+    utils.print2(f"Tile directory reduced to {round(total_size / 1024 ** 2)} MB", lvl=1)
+
+
+async def tile_eviction_loop() -> None:
+    while True:
+        await asyncio.to_thread(evict_tile_files)
+        await asyncio.sleep(config["cache"]["tiles_dir_eviction_interval"])
+
+
+def start_tile_eviction() -> None:
+    # Called from on_ready, which may run multiple times.
+    global tile_eviction_task
+    if config["cache"]["tiles_dir"] and (tile_eviction_task is None or tile_eviction_task.done()):
+        tile_eviction_task = asyncio.create_task(tile_eviction_loop())
+
+
+class UpstreamUnavailable(ValueError):
+    # Service didn't give usable answer (error page, server down). Unlike other ValueErrors,
+    # this doesn't say anything about the requested object, so it must not be cached
+    # or trusted as "does not exist".
+    pass
+
+
+async def _get_upstream(url: str) -> Tuple[int, str]:
+    # Same as _get, but dead or slow server is reported as UpstreamUnavailable, like error responses.
+    try:
+        return await _get(url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise UpstreamUnavailable(f"{urlparse(url).netloc} is unavailable: {e!r}")
+
+
+async def get_json(url: str) -> Any:
+    code, text = await _get_upstream(url)
+    if code != 200:
+        raise UpstreamUnavailable(f"{urlparse(url).netloc} responded with {code}.")
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        raise UpstreamUnavailable(f"{urlparse(url).netloc} returned invalid response.")
+
+
+async def overpass_query(query: str) -> overpy.Result:
+    # Async replacement for overpy.Overpass.query, status codes are handled the same way.
+    # Every caller parses the response separately, so that they don't share result objects.
+    code, text = await single_flight(("Overpass", query), _overpass_post, query)
+    if code == 200:
+        return overpass_parser.parse_json(text)
+    elif code == 400:
+        raise overpy.exception.OverpassBadRequest(query)
+    elif code == 429:
+        raise overpy.exception.OverpassTooManyRequests()
+    elif code == 504:
+        raise overpy.exception.OverpassGatewayTimeout()
+    raise overpy.exception.OverpassUnknownHTTPStatusCode(code)
+
+
+class OverpassEndpoint:
+    # Health of one Overpass server. Latency of recent answers is used for picking the fastest server
+    # and deciding when to send hedged request. After several failures in a row, circuit breaker opens
+    # and server is skipped for a while. Next failure after that opens it again right away.
+    def __init__(self, url: str):
+        self.url = url
+        self.latencies: deque = deque(maxlen=50)
+        self.failures = 0
+        self.open_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.open_until <= time.time()
+
+    def p95(self) -> float:
+        # Until there is enough data, configured default is used.
+        if len(self.latencies) < config["network"]["overpass_min_samples"]:
+            return config["network"]["overpass_hedge_delay"]
+        return sorted(self.latencies)[int(0.95 * (len(self.latencies) - 1))]
+
+    def expected_latency(self) -> float:
+        if not self.latencies:
+            return config["network"]["overpass_hedge_delay"]
+        return sum(self.latencies) / len(self.latencies)
+
+    def record_success(self, latency: float) -> None:
+        self.latencies.append(latency)
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= config["network"]["overpass_failure_threshold"]:
+            utils.print2(f"Overpass server {self.url} is failing, not using it for a while.", lvl=1)
+            self.open_until = time.time() + config["network"]["overpass_cooldown"]
+
+    def __repr__(self):
+        return f"OverpassEndpoint('{self.url}')"
+
+
+class OverpassEndpointError(Exception):
+    # Server answered with status that another server might not have (too many requests, gateway timeout...).
+    def __init__(self, code: int, text: str):
+        super().__init__(f"Overpass server responded with {code}")
+        self.code = code
+        self.text = text
+
+
+# Older configs only have single overpass_url.
+overpass_endpoints = [OverpassEndpoint(url) for url in config.get("overpass_urls") or [config["overpass_url"]]]
+
+
+async def _overpass_post(query: str) -> Tuple[int, str]:
+    # Sends query to the fastest healthy server. If it hasn't answered by it's usual p95 latency,
+    # same query is sent to the next server too (hedging) and whichever answers first is used.
+    # Failed servers are replaced with next one until all have been tried.
+    candidates = sorted(filter(lambda e: e.available, overpass_endpoints), key=lambda e: e.expected_latency())
+    if not candidates:  # Everything is broken, so try anyway.
+        candidates = list(overpass_endpoints)
+    running: Dict[asyncio.Task, OverpassEndpoint] = dict()
+    error: Optional[Exception] = None
+    try:
+        while True:
+            if not running:
+                if not candidates:
+                    break
+                endpoint = candidates.pop(0)
+                running[asyncio.create_task(_overpass_post_to(endpoint, query))] = endpoint
+                hedge_delay = endpoint.p95()
+            timeout = hedge_delay if candidates and len(running) < 2 else None
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                endpoint = candidates.pop(0)
+                utils.print2(f"Overpass is slow, hedging with {endpoint.url}", lvl=2)
+                running[asyncio.create_task(_overpass_post_to(endpoint, query))] = endpoint
+                continue
+            for task in done:
+                del running[task]
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+    finally:
+        for task in running:
+            task.cancel()
+    if isinstance(error, OverpassEndpointError):
+        return error.code, error.text
+    if error is None:
+        raise overpy.exception.OverpassError("No Overpass servers configured.")
+    raise error
+
+
+async def _overpass_post_to(endpoint: OverpassEndpoint, query: str) -> Tuple[int, str]:
+    session = await get_session()
+    start = time.time()
+    try:
+        async with session.post(endpoint.url, data=query.encode("utf-8")) as res:
+            code, text = res.status, await res.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        endpoint.record_failure()
+        raise
+    if code == 429 or code >= 500:
+        endpoint.record_failure()
+        raise OverpassEndpointError(code, text)
+    # Bad requests are query's fault, not server's, so they count as success.
+    endpoint.record_success(time.time() - start)
+    return code, text
+
+
+class ElementStore:
+    # SQLite copy of downloaded elements, changesets, notes and users, so that get_elm
+    # doesn't have to start from empty cache after restart. All database access happens
+    # in one background thread, so the event loop isn't blocked by disk I/O.
+    def __init__(self, path: str, max_rows: int):
+        self.path = path
+        self.max_rows = max_rows
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="element_store")
+        self._connection: Optional[sqlite3.Connection] = None
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            # WAL lets readers (other bot processes) work while something is being written.
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS elements (type TEXT, id TEXT, version INTEGER, discussion INTEGER,"
+                " data TEXT, fetched_at REAL, PRIMARY KEY (type, id, version, discussion))"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS elements_fetched_at ON elements (fetched_at)")
+        return self._connection
+
+    async def _run(self, func: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(
+        self, elm_type: str, elm_id: str, version: Optional[int], get_discussion: bool
+    ) -> Optional[Tuple[dict, float]]:
+        # Returns element and time when it was downloaded.
+        return await self._run(self._get, elm_type, elm_id, version, get_discussion)
+
+    def _get(self, elm_type, elm_id, version, get_discussion):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT data, fetched_at FROM elements WHERE type=? AND id=? AND version=? AND discussion=?",
+                (elm_type, elm_id, -1 if version is None else version, int(get_discussion)),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return _decode_stored_elm(row[0]), row[1]
+
+    async def put(self, elm_type: str, elm_id: str, version: Optional[int], get_discussion: bool, elm: dict) -> None:
+        await self._run(self._put, elm_type, elm_id, version, get_discussion, json.dumps(elm), time.time())
+
+    def _put(self, elm_type, elm_id, version, get_discussion, data, fetched_at):
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO elements VALUES (?, ?, ?, ?, ?, ?)",
+                (elm_type, elm_id, -1 if version is None else version, int(get_discussion), data, fetched_at),
+            )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._evict()
+
+    def _evict(self):
+        # Oldest downloads are removed first.
+        connection = self._connect()
+        rows = connection.execute("SELECT COUNT(*) FROM elements").fetchone()[0]
+        if rows > self.max_rows:
+            with connection:
+                connection.execute(
+                    "DELETE FROM elements WHERE rowid IN (SELECT rowid FROM elements ORDER BY fetched_at LIMIT ?)",
+                    (rows - self.max_rows,),
+                )
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
+
+
+def _decode_stored_elm(data: str) -> dict:
+    # JSON doesn't have tuples, but geometry of changesets and notes uses them.
+    elm = json.loads(data)
+    if "geometry" in elm and isinstance(elm["geometry"], list):
+        elm["geometry"] = [list(map(tuple, segment)) for segment in elm["geometry"]]
+    return elm
+
+
+# Elements returned by get_elm, keyed by (type, id, version, discussion). See _elm_ttl for expiry times.
+elm_cache = cache.LRUCache(max_size=config["cache"]["elements_max_size"])
+# Optional on-disk copy of elm_cache, disabled if store_file is empty.
+element_store = (
+    ElementStore(config["cache"]["store_file"], config["cache"]["store_max_rows"])
+    if config["cache"]["store_file"]
+    else None
+)
+# Stored rows older than this were downloaded before restart, see _get_cached_elm.
+process_started = time.time()
+
+
+async def close_element_store() -> None:
+    if element_store is not None:
+        await element_store.close()
+
+
+def _is_immutable(elm_type: str, elm: dict, get_discussion: bool, version: Optional[int]) -> bool:
+    # Specific versions of elements and closed changesets never change. Everything else
+    # (latest versions, notes, open changesets, users, discussions) may change any moment.
+    if version is not None:
+        return True
+    return elm_type == "changeset" and not elm["open"] and not get_discussion
+
+
+def _elm_ttl(elm_type: str, elm: dict, get_discussion: bool, version: Optional[int]) -> float:
+    if _is_immutable(elm_type, elm, get_discussion, version):
+        return config["cache"]["immutable_ttl"]
+    return config["cache"]["mutable_ttl"]
+
+
+async def get_elm(
+    elm_type: str, elm_id: Union[int, str], get_discussion: bool = False, version: Optional[int] = None
+) -> dict:
+    # Cached wrapper of download_elm. Version can be given for nodes, ways and relations.
+    if elm_type == "notes":
+        elm_type = "note"
+    elm = await _get_cached_elm(elm_type, elm_id, get_discussion, version)
+    if elm is None:
+        elm = await download_elm(elm_type, elm_id, get_discussion, version)
+        await _remember_elm(elm_type, elm_id, elm, get_discussion, version)
+    utils.print2("Element cache:", elm_cache.stats(), lvl=4)
+    # Callers modify returned elements (embeds pop used tags), so everyone gets their own copy.
+    return copy.deepcopy(elm)
+
+
+async def _get_cached_elm(
+    elm_type: str, elm_id: Union[int, str], get_discussion: bool = False, version: Optional[int] = None
+) -> Optional[dict]:
+    # Looks element up from memory first and then from disk, if element store is enabled.
+    elm = elm_cache.get((elm_type, str(elm_id), version, get_discussion))
+    if elm is not None or element_store is None:
+        return elm
+    stored = await element_store.get(elm_type, str(elm_id), version, get_discussion)
+    if stored is None:
+        return None
+    elm, fetched_at = stored
+    age = time.time() - fetched_at
+    if _is_immutable(elm_type, elm, get_discussion, version):
+        if age > config["cache"]["immutable_ttl"]:
+            return None
+        _cache_elm(elm_type, elm_id, elm, get_discussion, version, age)
+    else:
+        # Mutable rows downloaded before restart are trusted for store_restart_ttl, so that bot
+        # doesn't start with cold cache. Rows downloaded by this process follow mutable_ttl as usual.
+        if fetched_at >= process_started or age > config["cache"]["store_restart_ttl"]:
+            return None
+        _cache_elm(elm_type, elm_id, elm, get_discussion, version)
+    return elm
+
+
+async def _remember_elm(
+    elm_type: str, elm_id: Union[int, str], elm: dict, get_discussion: bool = False, version: Optional[int] = None
+) -> None:
+    _cache_elm(elm_type, elm_id, elm, get_discussion, version)
+    if element_store is not None:
+        await element_store.put(elm_type, str(elm_id), version, get_discussion, elm)
+
+
+def _cache_elm(
+    elm_type: str,
+    elm_id: Union[int, str],
+    elm: dict,
+    get_discussion: bool = False,
+    version: Optional[int] = None,
+    age: float = 0,
+) -> None:
+    # Age is time since element was downloaded, in case it comes from element store.
+    ttl = _elm_ttl(elm_type, elm, get_discussion, version) - age
+    elm_cache.set((elm_type, str(elm_id), version, get_discussion), elm, ttl)
+    if version is None and elm_type in ("node", "way", "relation"):
+        # Latest version is also stored as it's own version, which is immutable.
+        version_key = (elm_type, str(elm_id), elm["version"], get_discussion)
+        elm_cache.set(version_key, elm, config["cache"]["immutable_ttl"] - age)
+
+
+async def get_elms(elm_type: str, elm_ids: Iterable[Union[int, str]]) -> Dict[str, Union[dict, ValueError]]:
+    # Gets many nodes, ways or relations with as few requests as possible, using
+    # API's multi-fetch (nodes.json?nodes=1,2,3). Returns element or ValueError for each ID.
+    # Results are keyed by IDs as given, but matched by their numeric value, so "0123" finds element 123.
+    results: Dict[str, Union[dict, ValueError]] = dict()
+    to_download: Dict[str, list] = dict()  # Numeric ID -> IDs as given
+    for elm_id in map(str, elm_ids):
+        if not elm_id.isdigit():
+            # Inline matches may contain words like "and", which would fail whole multi-fetch.
+            results[elm_id] = ValueError(f"`{elm_id}` is not a valid {elm_type} ID.")
+            continue
+        elm = await _get_cached_elm(elm_type, str(int(elm_id)))
+        if elm is not None:
+            results[elm_id] = copy.deepcopy(elm)
+        else:
+            to_download.setdefault(str(int(elm_id)), []).append(elm_id)
+    numeric_ids = list(to_download)
+    for i in range(0, len(numeric_ids), MULTI_FETCH_LIMIT):
+        chunk = numeric_ids[i : i + MULTI_FETCH_LIMIT]
+        code, text = await _get(config["api_url"] + f"api/0.6/{elm_type}s.json?{elm_type}s=" + ",".join(chunk))
+        if code != 200:
+            # Whole request fails if any of the elements has never existed,
+            # so fall back to single requests to find out which one it was.
+            chunk_results = await asyncio.gather(*(_get_elm_or_error(elm_type, x) for x in chunk))
+        else:
+            downloaded = {str(elm["id"]): elm for elm in json.loads(text)["elements"]}
+            chunk_results = []
+            for elm_id in chunk:
+                if elm_id not in downloaded:
+                    chunk_results.append(ValueError(f"{elm_type.capitalize()} `{elm_id}` was not found."))
+                elif not downloaded[elm_id].get("visible", True):
+                    # Single element request would have returned 410 instead.
+                    chunk_results.append(ValueError(f"{elm_type.capitalize()} `{elm_id}` has been deleted."))
+                else:
+                    await _remember_elm(elm_type, elm_id, downloaded[elm_id])
+                    chunk_results.append(downloaded[elm_id])
+        for elm_id, elm in zip(chunk, chunk_results):
+            for given_id in to_download[elm_id]:
+                results[given_id] = elm if isinstance(elm, ValueError) else copy.deepcopy(elm)
+    utils.print2("Element cache:", elm_cache.stats(), lvl=4)
+    return results
+
+
+async def _get_elm_or_error(elm_type: str, elm_id: str) -> Union[dict, ValueError]:
+    try:
+        return await get_elm(elm_type, elm_id)
+    except ValueError as error_message:
+        return error_message
+
+
+async def download_elm(
+    elm_type: str, elm_id: Union[int, str], get_discussion: bool = False, version: Optional[int] = None
+) -> dict:
     # New, unified element query function.
     suffix = ""
     if get_discussion and elm_type == "changeset":
@@ -18,17 +761,19 @@ def get_elm(elm_type: str, elm_id: Union[int, str], get_discussion: bool = False
     if elm_type == "note" or elm_type == "notes":
         # Notes api is rather odd, as it has `noteS`, not `note`
         elm_type = "notes"
+    path = f"{elm_type}/{elm_id}"
+    if version is not None:
+        path += f"/{version}"
 
-    res = requests.get(config["api_url"] + f"api/0.6/{elm_type}/{elm_id}.json" + suffix)
+    code, text = await _get(config["api_url"] + f"api/0.6/{path}.json" + suffix)
     if elm_type == "notes":
         elm_type = "note"
-    code = res.status_code
     if code == 410:
         raise ValueError(f"{elm_type.capitalize()} `{elm_id}` has been deleted.")
     elif code == 404:
         raise ValueError(f"{elm_type.capitalize()} `{elm_id}` has never existed.")
     try:
-        elm = res.json()
+        elm = json.loads(text)
     except (json.decoder.JSONDecodeError):
         raise ValueError(f"{elm_type.capitalize()} `{elm_id}` does not exist.")
     if elm_type == "note":
@@ -61,19 +806,189 @@ def get_elm(elm_type: str, elm_id: Union[int, str], get_discussion: bool = False
     return elm
 
 
-def get_id_from_username(username: str) -> int:
-    whosthat = requests.get(config["whosthat_url"] + "whosthat.php?action=names&q=" + username).json()
+def load_username_cache() -> None:
+    global username_cache
+    if os.path.exists(config["cache"]["usernames_file"]):
+        with open(config["cache"]["usernames_file"], "r", encoding="utf8") as file:
+            username_cache = json.loads(file.read())
+
+
+def username_cache_changed() -> None:
+    # Changes are written to disk in batches, not on every lookup.
+    global username_cache_dirty
+    username_cache_dirty = True
+
+
+async def flush_username_cache() -> None:
+    # Writes username_cache to disk if it has changed. Called periodically and when the bot closes.
+    # File is written in a thread from a copy of the cache, so the event loop isn't blocked.
+    global username_cache_dirty
+    async with username_flush_lock:
+        if not username_cache_dirty:
+            return
+        username_cache_dirty = False
+        # Expired entries are dropped, so that file doesn't grow forever.
+        for username in [name for name, entry in username_cache.items() if not _username_entry_fresh(entry)]:
+            del username_cache[username]
+        snapshot = {username: dict(entry) for username, entry in username_cache.items()}
+        await asyncio.to_thread(_write_username_file, snapshot)
+
+
+def _write_username_file(data: Dict[str, dict]) -> None:
+    os.makedirs(os.path.dirname(config["cache"]["usernames_file"]) or ".", exist_ok=True)
+    temp_file = config["cache"]["usernames_file"] + ".tmp"
+    with open(temp_file, "w", encoding="utf8") as file:
+        file.write(json.dumps(data))
+    os.replace(temp_file, config["cache"]["usernames_file"])
+
+
+async def username_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(config["cache"]["usernames_flush_interval"])
+        await flush_username_cache()
+
+
+def start_username_flush() -> None:
+    # Called from on_ready, which may run multiple times.
+    global username_flush_task
+    if username_flush_task is None or username_flush_task.done():
+        username_flush_task = asyncio.create_task(username_flush_loop())
+
+
+def _username_entry_fresh(entry: dict) -> bool:
+    # Failed lookups are remembered for much shorter time, as the user may just be too new.
+    if entry["uid"] is None:
+        return entry["time"] + config["cache"]["username_negative_ttl"] > time.time()
+    return entry["time"] + config["cache"]["username_ttl"] > time.time()
+
+
+def forget_username(username: str) -> None:
+    if username in username_cache:
+        del username_cache[username]
+        username_cache_changed()
+
+
+async def get_id_from_username(username: str) -> str:
+    # Cached wrapper of lookup_id_from_username.
+    entry = username_cache.get(username)
+    if entry is not None and _username_entry_fresh(entry):
+        if entry["uid"] is None:
+            raise ValueError(entry["error"])
+        return entry["uid"]
+    try:
+        uid = str(await lookup_id_from_username(username))
+    except UpstreamUnavailable:
+        raise  # Outage says nothing about the user, so it's not cached.
+    except ValueError as error_message:
+        username_cache[username] = {"uid": None, "error": str(error_message), "time": time.time()}
+        username_cache_changed()
+        raise
+    # Display name is filled in by get_user, once it has seen the user's profile.
+    username_cache[username] = {"uid": uid, "display_name": None, "time": time.time()}
+    username_cache_changed()
+    return uid
+
+
+async def get_user(username: str) -> dict:
+    # Resolves username and downloads the user. Usernames can be changed, so if the
+    # profile doesn't match the cached entry, the user is looked up again.
+    for attempt in range(2):
+        uid = await get_id_from_username(username)
+        entry = username_cache[username]
+        try:
+            user = await get_elm("user", uid)
+        except ValueError:
+            if entry["display_name"] is None or attempt > 0:
+                raise
+            forget_username(username)  # Cached account has been deleted since.
+            continue
+        if entry["display_name"] is None:
+            entry["display_name"] = user["display_name"]
+            username_cache_changed()
+        elif entry["display_name"] != user["display_name"] and attempt == 0:
+            forget_username(username)  # Cached account has been renamed since.
+            continue
+        return user
+
+
+async def lookup_id_from_username(username: str) -> Union[int, str]:
+    # There are three ways to find user ID: whosthat, changesets and notes. In "race" mode they are started
+    # (staggered) at the same time and first answer is used, otherwise they are tried one after another.
+    strategies = [_uid_from_whosthat, _uid_from_changesets, _uid_from_notes]
+    if config["network"]["username_lookup"] == "race":
+        uid = await _race_uid_lookups(username, strategies, config["network"]["username_lookup_stagger"])
+    else:
+        uid = None
+        unavailable = None
+        for strategy in strategies:
+            try:
+                uid = await strategy(username)
+            except UpstreamUnavailable as error_message:
+                unavailable = error_message  # Try next one, but report it if no one finds the user.
+                continue
+            if uid is not None:
+                break
+        if uid is None and unavailable is not None:
+            raise unavailable
+    if uid is None:
+        raise ValueError(f"User `{username}` does exist, but has no changesets nor notes.")
+    return uid
+
+
+async def _race_uid_lookups(username: str, strategies: list, stagger: float) -> Union[int, str, None]:
+    # Any found ID is returned immediately. "User does not exist" is only trusted once all
+    # strategies before it (in sequential order) have finished without finding the user.
+    async def staggered(delay, strategy):
+        await asyncio.sleep(delay)
+        return await strategy(username)
+
+    tasks = [asyncio.create_task(staggered(i * stagger, strategy)) for i, strategy in enumerate(strategies)]
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result() is not None:
+                    return task.result()
+            for task in tasks:
+                if not task.done():
+                    break
+                error = task.exception()
+                if isinstance(error, ValueError) and not isinstance(error, UpstreamUnavailable):
+                    raise error
+        # Nobody found the user. If some lookups failed for other reasons (e.g. server down), report that.
+        for task in tasks:
+            if task.exception() is not None:
+                raise task.exception()
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _uid_from_whosthat(username: str) -> Optional[int]:
+    whosthat = await get_json(config["whosthat_url"] + "whosthat.php?action=names&q=" + username)
     if len(whosthat) > 0:
         return whosthat[0]["id"]
+    return None
+
+
+async def _uid_from_changesets(username: str) -> Optional[str]:
     # Backup solution via changesets
-    res = requests.get(config["api_url"] + f"api/0.6/changesets/?display_name={username}").text
+    code, res = await _get_upstream(config["api_url"] + f"api/0.6/changesets/?display_name={username}")
     if res == "Object not found":
         raise ValueError(f"User `{username}` does not exist.")
+    if code != 200:
+        raise UpstreamUnavailable(f"OSM API responded with {code}.")
     if "uid=" in res:
         # +5 and -2 are used to isolate uid from `uid="123" `.
         return res[res.find('uid="') + 5 : res.find('user="') - 2]
+    return None
+
+
+async def _uid_from_notes(username: str) -> Optional[str]:
     # Backup of a backup by using notes lookup.
-    res = requests.get(config["api_url"] + f"api/0.6/notes/search.json/?display_name={username}").json()
+    res = await get_json(config["api_url"] + f"api/0.6/notes/search.json/?display_name={username}")
     for feat in res["features"]:
         for comm in feat["properties"]["comments"]:
             try:
@@ -81,4 +996,7 @@ def get_id_from_username(username: str) -> int:
                     return str(comm["uid"])
             except KeyError:
                 pass  # Encountered anonymous note
-    raise ValueError(f"User `{username}` does exist, but has no changesets nor notes.")
+    return None
+
+
+load_username_cache()
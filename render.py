@@ -7,18 +7,24 @@
 # tiles_x/tiles_y - Dimensions of output map fragment
 # tile_margin_x / tile_margin_y - How much free space is left at edges
 # Colours need to be reworked for something prettier, therefore don't relocate them yet.
+import math
+import time
+from collections import defaultdict
 from io import BytesIO
+from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Tuple
 from typing import Union
 
+import aiohttp
+import numpy as np
 import overpy
-import requests
 from discord import Message
 from PIL import Image
 from PIL import ImageDraw  # For drawing elements
 
+import cache
 import colors
 import network
 import utils
@@ -27,22 +33,29 @@ from configuration import config
 # Used in render_elms_on_cluster. List of colours to be cycled.
 element_colors = ["#000", "#700", "#f00", "#070", "#0f0", "#f60"]
 
-if config["symbols"]["note_solved"].startswith("http"):
-    res = requests.get(config["symbols"]["note_solved"], headers=config["rendering"]["HEADERS"])
-    closed_note_icon = Image.open(BytesIO(res.content))
-else:
-    closed_note_icon = Image.open(open(config["symbols"]["note_solved"], "rb"))
-if config["symbols"]["note_open"].startswith("http"):
-    res = requests.get(config["symbols"]["note_open"], headers=config["rendering"]["HEADERS"])
-    open_note_icon = Image.open(BytesIO(res.content))
-else:
-    # https://stackoverflow.com/a/11895901
-    open_note_icon = Image.open(open(config["symbols"]["note_open"], "rb"))
-
-open_note_icon_size = open_note_icon.size
-closed_note_icon_size = closed_note_icon.size
+# Note icons are loaded by load_icons, once shared HTTP session is available.
+closed_note_icon = None
+open_note_icon = None
 LOADING_EMOJI = config["emoji"]["loading"]  # :loading:
-overpass_api = overpy.Overpass(url=config["overpass_url"])
+
+
+async def _load_icon(session: aiohttp.ClientSession, location: str) -> Image.Image:
+    # Icons are decoded right away, as they are shared by renders running in parallel threads.
+    if location.startswith("http"):
+        async with session.get(location, headers=config["rendering"]["HEADERS"]) as res:
+            icon = Image.open(BytesIO(await res.read()))
+            icon.load()  # Image.open is lazy, decode now.
+            return icon
+    with open(location, "rb") as file:
+        icon = Image.open(file)
+        icon.load()
+    return icon
+
+
+async def load_icons(session: aiohttp.ClientSession) -> None:
+    global closed_note_icon, open_note_icon
+    closed_note_icon = await _load_icon(session, config["symbols"]["note_solved"])
+    open_note_icon = await _load_icon(session, config["symbols"]["note_open"])
 
 
 # Rendering system may need a rewrite which focuses on object-oriented approach.
@@ -73,12 +86,19 @@ class _BaseElement:
         self.colour = None  # Use default colour palette
         # Parent queue is RenderQueue and it's only purpose is to be passed to RenderSegment
         self.parent_queue = parent_queue
-        self.elm = network.get_elm(elm_type, id, "dicussion" in kwargs and kwargs["dicussion"])
+        self.get_discussion = "dicussion" in kwargs and kwargs["dicussion"]
+        # Element's metadata from OSM API. Downloaded by fetch(), so that creating elements doesn't block.
+        self.elm = None
+
+    async def fetch(self):
+        self.elm = await network.get_elm(self.type, self.id, self.get_discussion)
 
-    def resolve(self):
+    async def resolve(self):
         # Add code for geometry lookup.
         # What this func does: Run overpass or API query to get the element,
         # Save result as RenderSegment
+        if self.elm is None:
+            await self.fetch()
         self.resolved = True
         pass
 
@@ -95,34 +115,40 @@ class Note(_BaseElement):
     def __init__(self, id, parent_queue):
         super().__init__("note", id, parent_queue)
 
-    def resolve(self):
-        super().resolve()
+    async def resolve(self):
+        await super().resolve()
 
 
 class Changeset(_BaseElement):
     def __init__(self, id, parent_queue, get_discussion: bool = False):
         super().__init__("changeset", id, parent_queue, dicussion=get_discussion)
 
-    def resolve(self):
-        super().resolve()
+    async def resolve(self):
+        await super().resolve()
 
 
 class User(_BaseElement):
     def __init__(self, username, parent_queue):
-        super().__init__("user", network.get_id_from_username(username), parent_queue)
+        # User ID is looked up during fetch.
+        super().__init__("user", None, parent_queue)
         self.name = str(username)
 
-    def resolve(self):
-        super().resolve()
+    async def fetch(self):
+        self.elm = await network.get_user(self.name)
+        self.id = str(self.elm["id"])
+
+    async def resolve(self):
+        await super().resolve()
 
 
 class Element(_BaseElement):
     def __init__(self, elm_type, id, parent_queue):
         super().__init__(elm_type, id, parent_queue)
 
-    def resolve(self):
-        super().resolve()
+    async def resolve(self):
+        await super().resolve()
         self.geometry = RenderSegment(self, self.parent_queue)
+        await self.geometry.fetch()
 
 
 # The point is that it's not feasible to maintain every node-way-relation of every element, because they will grow large; therefore they need to be optimized into something simpler... I have hit multiple walls again.
@@ -177,17 +203,17 @@ class RenderQueue:
             else:
                 self.elements.append(Element(element[0], element[1], self))
 
-    def resolve(self):
+    async def resolve(self):
         # Queries elements to resolve geometry.
         # Resolve is term from overpass query processing for relations,
         # where initial query has only metadata and you need separate command
         # to download actual geometry information.
         if self.resolved:
             return
-        for elements in [self.elements, self.changesets, self.notes]:
+        for elements in [self.elements, self.changesets, self.notes, self.users]:
             for element in elements:
                 if not element.resolved:
-                    element.resolve()
+                    await element.resolve()
         self.resolved = True
 
     def get_bounds(self, segments=True, notes=True) -> Tuple[float, float, float, float]:
@@ -233,39 +259,8 @@ class RenderQueue:
         return (min_lat, max_lat, min_lon, max_lon)
 
     def calc_preview_area(self) -> Tuple[int, float, float]:
-        # queue_bounds: tuple[float, float, float, float]
-
-        # Input: tuple (min_lat, max_lat, min_lon, max_lon)
-        # Output: tuple (int(zoom), float(lat), float(lon))
-        # Based on old showmap function and https://wiki.openstreetmap.org/wiki/Zoom_levels
-        # Finds map area, that should contain all elements.
-        # I think this function causes issues with incorrect rendering due to using average of boundaries, not tiles.
-        print("Elements bounding box:", *list(map(lambda x: round(x, 4), self.queue_bounds)))
-        min_lat, max_lat, min_lon, max_lon = self.queue_bounds
-        delta_lat = max_lat - min_lat
-        delta_lon = max_lon - min_lon
-        zoom_x = int(
-            math.log2((360 / delta_lon) * (config["rendering"]["tiles_x"] - 2 * config["rendering"]["tile_margin_x"]))
-        )
-        center_lon = delta_lon / 2 + min_lon
-        # Zoom level is determined by trying to fit x/y bounds into 5 tiles.
-        zoom_y = config["rendering"]["max_zoom"] + 1
-        while (utils.deg2tile(min_lat, 0, zoom_y)[1] - utils.deg2tile(max_lat, 0, zoom_y)[1] + 1) > config["rendering"][
-            "tiles_y"
-        ] - 2 * config["rendering"]["tile_margin_y"]:
-            zoom_y -= 1  # Bit slow and dumb approach
-        zoom = min(zoom_x, zoom_y, config["rendering"]["max_zoom"])
-        tile_y_min = utils.deg2tile_float(max_lat, 0, zoom)[1]
-        tile_y_max = utils.deg2tile_float(min_lat, 0, zoom)[1]
-        print(zoom, center_lon)
-        if zoom < 10:
-            # At low zoom levels and high latitudes, mercator's distortion must be accounted
-            center_lat = round(utils.tile2deg(zoom, 0, (tile_y_max + tile_y_min) / 2)[0], 5)
-        else:
-            center_lat = (max_lat - min_lat) / 2 + min_lat
-        print(center_lat, min_lat, max_lat)
-        self.preview_area = (zoom, center_lat, center_lon)
-        return (zoom, center_lat, center_lon)
+        self.preview_area = calc_preview_area(self.queue_bounds)
+        return self.preview_area
 
     def set_status(self, text: str):
         # Type MUST be str
@@ -305,15 +300,27 @@ class RenderSegment:
         # This is used for ways of the element. Infividual nodes are single-node segments.
         # Uses same typing as old rendering module (that's: [(Lat1,Lon1), (Lat2, Lon2)])... i hope
         self.segments = []
-        
+        self.parent_queue = parent_queue
+        self.recursion_depth = recursion_depth
+        self.tags = dict()
+
+    async def fetch(self):
         output_type = "body"  # Original version
-        if parent_elm.type == "relation" and 1 < recursion_depth:
+        if self.parent_elm.type == "relation" and 1 < self.recursion_depth:
             output_type = "center"  # Alternative: "bb"
-        Q = "[out:json][timeout:45];"+parent_elm.type+"(id:" + str(parent_elm.id) + ");(._;>;);out " + output_type + ";"
-        parent_queue.set_status(f"{LOADING_EMOJI} Querying `" + Q + "`")
+        Q = (
+            "[out:json][timeout:45];"
+            + self.parent_elm.type
+            + "(id:"
+            + str(self.parent_elm.id)
+            + ");(._;>;);out "
+            + output_type
+            + ";"
+        )
+        self.parent_queue.set_status(f"{LOADING_EMOJI} Querying `" + Q + "`")
         # Above line may introduce error when running it from /element, not on_message.
-        result = overpass_api.query(Q)
-        self.tags = eval("result."+parent_elm.type+"s[0].tags")
+        result = await network.overpass_query(Q)
+        self.tags = eval("result." + self.parent_elm.type + "s[0].tags")
 
     def reduce(self):
         # See  def reduce_segment_nodes(segments
@@ -382,39 +389,50 @@ class RenderSegment:
 """
 
 
-def reduce_segment_nodes(segments: List[List[Tuple[float, float]]]) -> List[List[Tuple[float, float]]]:
-    # Relative simple way to reduce nodes by just picking every n-th node.
-    # Ignores ways with less than 50 nodes.
-    for seg_num in range(len(segments)):
-        segment = segments[seg_num]  # For each segment
-        seg_len = len(segment)
-        limit = RenderSegment.calc_limit(seg_len)  # Get number of nodes allowed
-        step = seg_len / limit  # Average number of nodes to be skipped
-        position = 0
-        temp_array = []
-        while position < seg_len:  # Iterates over segment
-            temp_array.append(segment[int(position)])  # And select only every step-th node
-            position += step  # Using int(position) because step is usually float.
-        if int(position - step) != seg_len - 1:  # Always keep last node,
-            temp_array.append(segment[-1])  # But only if it's not added already.
-        # Convert overpy-node-objects into (lat, lon) pairs.
-        try:
-            segments[seg_num] = list(map(lambda x: (float(x.lat), float(x.lon)), temp_array))
-        except AttributeError:
-            pass  # Encountered relation node, see ln 794
-    reduced = list(map(list, set(map(tuple, segments))))
-    print(len(segments), len(reduced))
-    # with elms_to_render('relation','908054')
-    # Result:  15458 vs 6564
-    return reduced
+def simplify_segment(points: np.ndarray, tolerance: float) -> np.ndarray:
+    # Douglas-Peucker: keeps point furthest from line between kept points, until all
+    # dropped points are within tolerance (in pixels) of the simplified line.
+    if len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        first, last = points[start], points[end]
+        inner = points[start + 1 : end]
+        dx, dy = last - first
+        length = math.hypot(dx, dy)
+        if length == 0:  # Closed ring, measure distance from the start point instead.
+            distances = np.hypot(inner[:, 0] - first[0], inner[:, 1] - first[1])
+        else:
+            distances = np.abs(dx * (inner[:, 1] - first[1]) - dy * (inner[:, 0] - first[0])) / length
+        furthest = int(np.argmax(distances))
+        if distances[furthest] > tolerance:
+            furthest += start + 1
+            keep[furthest] = True
+            stack.append((start, furthest))
+            stack.append((furthest, end))
+    return points[keep]
+
+
+def reduce_segment_nodes(segments: List[np.ndarray], tolerance: Optional[float] = None) -> List[np.ndarray]:
+    # Simplifies already projected segments (see project_segments), so that result differs from
+    # original by less than tolerance pixels. Unlike picking every n-th node, corners are kept
+    # and straight parts collapse to their end points.
+    if tolerance is None:
+        tolerance = config["rendering"]["simplify_tolerance_px"]
+    return [simplify_segment(segment, tolerance) for segment in segments]
 
 
 def get_image_tile_range(lat_deg: float, lon_deg: float, zoom: int) -> Tuple[int, int, int, int, Tuple[float, float]]:
     # Following line is duplicataed at calc_preview_area()
     center_x, center_y = utils.deg2tile_float(lat_deg, lon_deg, zoom)
-    utils.print("Center X/Y:", center_x, center_y, lvl=3)
+    utils.print2("Center X/Y:", center_x, center_y, lvl=3)
     xmin, xmax = int(center_x - config["rendering"]["tiles_x"] / 2), int(center_x + config["rendering"]["tiles_x"] / 2)
-    utils.print("X min/max:", xmin, xmax, lvl=3)
+    utils.print2("X min/max:", xmin, xmax, lvl=3)
     n = 2 ** zoom  # N is number of tiles in one direction on zoom level
     if config["rendering"]["tiles_x"] % 2 == 0:
         xmax -= 1
@@ -429,8 +447,8 @@ def get_image_tile_range(lat_deg: float, lon_deg: float, zoom: int) -> Tuple[int
     # tile_offset - By how many tiles should tile grid shifted somewhere (up left?).
     # Constant offset: if map is odd number of tiles wide,
     #  offset will be increased by half of a tile.
-    utils.print("Tile offset calculation", lvl=4)
-    utils.print(
+    utils.print2("Tile offset calculation", lvl=4)
+    utils.print2(
         "center_x:",
         center_x,
         "\nConstant X offset:",
@@ -448,13 +466,41 @@ def get_image_tile_range(lat_deg: float, lon_deg: float, zoom: int) -> Tuple[int
         (center_y + (config["rendering"]["tiles_y"] % 2) / 2) % 1,
     )
     # tile_offset = 0,0
-    utils.print("Offset (X/Y, Lon/Lat):", tile_offset, lvl=2)
-    utils.print(
+    utils.print2("Offset (X/Y, Lon/Lat):", tile_offset, lvl=2)
+    utils.print2(
         f"get_image_tile_range{(lat_deg, lon_deg, zoom)} -> {(xmin, xmax - 1, ymin, ymax - 1, tile_offset)}", lvl=3
     )
     return xmin, xmax - 1, ymin, ymax - 1, tile_offset
 
 
+def get_visible_tiles(zoom: int, tile_range) -> List[Tuple[int, int]]:
+    # Returns X/Y of tiles that are at least partially on map fragment, in same coordinates as
+    # utils.tile2pixel expects. X may be outside of 0..N near -180/180 meridian, Y is never.
+    n = 2 ** zoom
+    canvas_w = config["rendering"]["tiles_x"] * config["rendering"]["tile_w"] - 1
+    canvas_h = config["rendering"]["tiles_y"] * config["rendering"]["tile_h"] - 1
+    xmin, xmax, ymin, ymax, tile_offset = tile_range
+    # Top-left corner of map fragment in tile coordinates, see utils.tile2pixel.
+    left, top = xmin + tile_offset[0], ymin + tile_offset[1]
+    if zoom < 3:
+        left, top = left - 1, top - 1
+    # Candidates are one tile wider on each side, exact check is done in pixels
+    # so that rounding matches tile2pixel.
+    columns = [
+        x
+        for x in range(math.floor(left) - 1, math.ceil(left + canvas_w / config["rendering"]["tile_w"]) + 1)
+        if -config["rendering"]["tile_w"] < round((x - left) * config["rendering"]["tile_w"]) < canvas_w
+    ]
+    rows = [
+        y
+        for y in range(
+            max(0, math.floor(top) - 1), min(n, math.ceil(top + canvas_h / config["rendering"]["tile_h"]) + 1)
+        )
+        if -config["rendering"]["tile_h"] < round((y - top) * config["rendering"]["tile_h"]) < canvas_h
+    ]
+    return [(x, y) for x in columns for y in rows]
+
+
 def draw_line(segment: List[Tuple[float, float]], draw, colour="red") -> None:
     # https://stackoverflow.com/questions/59060887
     # This is polyline of all coordinates on array.
@@ -471,26 +517,163 @@ def draw_node(coord: Tuple[float, float], draw, colour="red") -> None:
     draw.ellipse(twoPointList, fill=colour)
 
 
-def render_notes_on_cluster(Cluster, notes: List[Tuple[float, float, bool]], frag: Tuple[int, float, float], filename):
+def stitch_tiles(tiles: List[Tuple[Image.Image, Tuple[int, int]]]) -> Image.Image:
+    # Pastes downloaded tiles to their positions on empty map fragment.
+    cluster = Image.new(
+        "RGB",
+        (
+            config["rendering"]["tiles_x"] * config["rendering"]["tile_w"] - 1,
+            config["rendering"]["tiles_y"] * config["rendering"]["tile_h"] - 1,
+        ),
+    )
+    for tile, position in tiles:
+        cluster.paste(tile, position)
+    return cluster
+
+
+# Encoded map fragments (without elements), see fragment_key.
+fragment_cache = cache.LRUCache(max_bytes=config["cache"]["fragments_max_bytes"], sizeof=len)
+# Output format -> file extension used for upload.
+output_extensions = {"webp": "webp", "jpeg": "jpg", "png": "png", "png8": "png"}
+# Output format -> [images encoded, seconds spent, bytes produced], see record_encode.
+encode_stats: Dict[str, List[float]] = {}
+
+
+def _fragment_grid_cell(lat_deg: float, lon_deg: float, zoom: int) -> Tuple[int, int]:
+    grid = config["cache"]["fragments_grid_px"]
+    x, y = utils.deg2tile_float(lat_deg, lon_deg, zoom)
+    return round(x * config["rendering"]["tile_w"] / grid), round(y * config["rendering"]["tile_h"] / grid)
+
+
+def snap_to_fragment_grid(lat_deg: float, lon_deg: float, zoom: int) -> Tuple[float, float]:
+    # Center of fragment is snapped to grid of few pixels, so that links that differ only
+    # in last decimals of coordinates share cached image. Cached fragments are rendered at
+    # snapped center, so that every link using it is off by at most half of grid.
+    grid = config["cache"]["fragments_grid_px"]
+    cell_x, cell_y = _fragment_grid_cell(lat_deg, lon_deg, zoom)
+    x, y = cell_x * grid / config["rendering"]["tile_w"], cell_y * grid / config["rendering"]["tile_h"]
+    return utils.tile2deg(zoom, 0, y)[0], x / 2 ** zoom * 360 - 180
+
+
+def fragment_key(lat_deg: float, lon_deg: float, zoom: int, tile_url: str) -> Tuple:
+    # See snap_to_fragment_grid.
+    return (zoom, tile_url, config["rendering"]["output"]["format"], *_fragment_grid_cell(lat_deg, lon_deg, zoom))
+
+
+def encode_image(image: Image.Image, output_format: str) -> Tuple[bytes, float]:
+    # Rendered maps are sent from memory, so that concurrent renders can't overwrite each other's files.
+    # Returns encoded image and time spent on encoding. Output format is set in config["rendering"]["output"].
+    # Lossy formats are much smaller than full colour PNG, which means faster upload to Discord.
+    settings = config["rendering"]["output"]
+    t = time.time()
+    buffer = BytesIO()
+    if output_format == "webp":
+        image.save(buffer, "WEBP", quality=settings["quality"], method=settings["webp_method"])
+    elif output_format == "jpeg":
+        image.convert("RGB").save(buffer, "JPEG", quality=settings["quality"], optimize=True)
+    elif output_format == "png8":
+        # Map tiles have few distinct colours, so palette barely changes how map looks.
+        image = image.convert("RGB").quantize(colors=settings["png_colors"], method=Image.FASTOCTREE)
+        image.save(buffer, "PNG", compress_level=settings["png_compress_level"])
+    else:
+        image.save(buffer, "PNG", compress_level=settings["png_compress_level"])
+    return buffer.getvalue(), time.time() - t
+
+
+def record_encode(output_format: str, seconds: float, size: int) -> None:
+    # Keeps running totals per format, so that operators can compare formats from log.
+    count, total_seconds, total_bytes = encode_stats.get(output_format, [0, 0.0, 0])
+    encode_stats[output_format] = [count + 1, total_seconds + seconds, total_bytes + size]
+    count, total_seconds, total_bytes = encode_stats[output_format]
+    utils.print2(
+        f"Encoded {output_format}: {size} bytes in {round(seconds * 1000)} ms",
+        f"(average of {count}: {round(total_bytes / count)} bytes in {round(total_seconds / count * 1000)} ms)",
+        lvl=2,
+    )
+
+
+def render_notes_on_cluster(
+    Cluster,
+    notes: List[Tuple[float, float, bool]],
+    frag: Tuple[int, float, float],
+    icons: Tuple[Image.Image, Image.Image],
+):
+    # Icons are (open, closed) note icons. They are passed in, because with process
+    # pool executor load_icons has never been called in the process running this.
     # tile_offset - By how many tiles should tile grid shifted somewhere.
     tile_range = get_image_tile_range(frag[1], frag[2], frag[0])
     errorlog = []
+    open_icon, closed_icon = icons
     for note in notes:
         # TODO: Unify coordinate conversion functions.
         coord = utils.wgs2pixel(note, tile_range, frag)
-        utils.print(coord, lvl=5)
+        utils.print2(coord, lvl=5)
         if note[2]:  # If note is closed
-            note_icon = closed_note_icon
-            icon_pos = (int(coord[0] - closed_note_icon_size[0] / 2), int(coord[1] - closed_note_icon_size[1]))
+            note_icon = closed_icon
         else:
-            note_icon = open_note_icon
-            icon_pos = (int(coord[0] - open_note_icon_size[0] / 2), int(coord[1] - open_note_icon_size[1]))
+            note_icon = open_icon
+        icon_pos = (int(coord[0] - note_icon.size[0] / 2), int(coord[1] - note_icon.size[1]))
         # https://stackoverflow.com/questions/5324647
-        utils.print(icon_pos, lvl=5)
+        utils.print2(icon_pos, lvl=5)
         Cluster.paste(note_icon, icon_pos, note_icon)
         del note_icon
-    Cluster.save(filename)
-    return Cluster, filename
+    return Cluster
+
+
+def project_segments(
+    segments: List[List[Tuple[float, float]]], tile_range, frag: Tuple[int, float, float]
+) -> List[np.ndarray]:
+    # Converts [[(lat, lon), ...], ...] to list of pixel coordinate arrays with single utils.wgs2pixel_batch call.
+    lengths = [len(segment) for segment in segments]
+    if not sum(lengths):
+        return [np.empty((0, 2)) for segment in segments]
+    pixels = utils.wgs2pixel_batch([point for segment in segments for point in segment], tile_range, frag)
+    return np.split(pixels, np.cumsum(lengths)[:-1])
+
+
+def clip_segments(segments: List[np.ndarray], margin: Optional[float] = None) -> List[np.ndarray]:
+    # Cuts projected segments to map fragment (plus margin), so that off-screen parts are neither
+    # simplified nor drawn. Segment that leaves and re-enters map is split into multiple segments.
+    # Uses Liang-Barsky line clipping on all lines of segment at once.
+    if margin is None:
+        margin = config["rendering"]["clip_margin_px"]
+    x_min, y_min = -margin, -margin
+    x_max = config["rendering"]["tiles_x"] * config["rendering"]["tile_w"] - 1 + margin
+    y_max = config["rendering"]["tiles_y"] * config["rendering"]["tile_h"] - 1 + margin
+    clipped = []
+    for segment in segments:
+        if len(segment) == 1:
+            x, y = segment[0]
+            if x_min <= x <= x_max and y_min <= y <= y_max:
+                clipped.append(segment)
+            continue
+        start, delta = segment[:-1], segment[1:] - segment[:-1]
+        # Visible part of each line is start + t * delta, where t_start <= t <= t_end.
+        t_start, t_end = np.zeros(len(start)), np.ones(len(start))
+        visible = np.ones(len(start), dtype=bool)
+        for p, q in (
+            (-delta[:, 0], start[:, 0] - x_min),
+            (delta[:, 0], x_max - start[:, 0]),
+            (-delta[:, 1], start[:, 1] - y_min),
+            (delta[:, 1], y_max - start[:, 1]),
+        ):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                t = q / p
+            visible &= (p != 0) | (q >= 0)  # Parallel to this edge and outside of it.
+            t_start = np.where(p < 0, np.maximum(t_start, t), t_start)
+            t_end = np.where(p > 0, np.minimum(t_end, t), t_end)
+        visible &= t_start <= t_end
+        # Line continues previous one, if both are visible and the node between them is inside.
+        continues = np.zeros(len(start), dtype=bool)
+        continues[1:] = visible[1:] & visible[:-1] & (t_end[:-1] == 1) & (t_start[1:] == 0)
+        first_points = start + t_start[:, None] * delta
+        last_points = start + t_end[:, None] * delta
+        # Each run of continuing lines becomes one segment. Run ends where next one doesn't continue it.
+        breaks = np.append(np.flatnonzero(~continues), len(start))
+        for run_start in np.flatnonzero(visible & ~continues):
+            run_end = breaks[np.searchsorted(breaks, run_start, side="right")]
+            clipped.append(np.vstack((first_points[run_start], last_points[run_start:run_end])))
+    return clipped
 
 
 def render_elms_on_cluster(Cluster, render_queue: List[List[Tuple[float, float]]], frag: Tuple[int, float, float]):
@@ -507,63 +690,108 @@ def render_elms_on_cluster(Cluster, render_queue: List[List[Tuple[float, float]]
     draw = ImageDraw.Draw(Cluster)  # Not sure what it does, just following https://stackoverflow.com/questions/59060887
     # Basic demo for colour picker.
     len_colors = len(element_colors)
-    for seg_num in range(len(render_queue)):
-        for i in range(len(render_queue[seg_num])):
-            render_queue[seg_num][i] = utils.wgs2pixel(render_queue[seg_num][i], tile_range, frag)
+    # All segments are projected in one batch, then split back to segments.
+    segments = reduce_segment_nodes(clip_segments(project_segments(render_queue, tile_range, frag)))
+    for seg_num in range(len(segments)):
+        segment = [tuple(point) for point in segments[seg_num].tolist()]
         # Draw segment onto image
         color = element_colors[seg_num % len_colors]
-        draw_line(render_queue[seg_num], draw, color)
+        draw_line(segment, draw, color)
         # Maybe nodes shouldn't be rendered, if way has many, let's say 80+ nodes,
         # because it would become too cluttered?  This is very indecisive function.
         draw_nodes = False
-        if len(render_queue[seg_num]) < 80:
+        if len(segment) < 80:
             draw_nodes = True
-        if len(render_queue) > 40:
+        if len(segments) > 40:
             draw_nodes = False
-        if len(render_queue[seg_num]) == 1:
+        if len(segment) == 1:
             draw_nodes = True
         if draw_nodes:
-            draw_node(render_queue[seg_num][0], draw, color)
-            if len(render_queue[seg_num]) > 1:
-                for node_num in range(1, len(render_queue[seg_num])):
-                    draw_node(render_queue[seg_num][node_num], draw, color)
-    filename = config["map_save_file"].format(t=time.time())
+            for node in segment:
+                draw_node(node, draw, color)
     if True:
         draw_node((640.0, 640.0), draw, "#088")
         coord = utils.wgs2pixel((frag[1], frag[2]), tile_range, frag)
         print("Map alignment error: ", coord[0] - 640, coord[1] - 640)
         draw_node(coord, draw, "#bb0")
         print(640, 640, " ", *coord)
-    print(f"Saved drawn image as {filename}.")
-    Cluster.save(filename)
-    return Cluster, filename
+    return Cluster
     # I barely know how to draw lines in PIL
 
 
 def merge_segments(segments: List[List[Tuple[float, float]]]) -> List[List[Tuple[float, float]]]:
-    # Other bug occurs in case some ways of relation are reversed.
-    # Ideally, this should merge two segments, if they share same end and beginning node.
-    # Merges some ways together. For russia, around 4000 ways became 34 segments.
-
-    # first = (float(geom[0].lat), float(geom[0].lon))
-    # last = (float(geom[-1].lat), float(geom[-1].lon))
-    # # Adding and removing elements is faster at end of list
-    # if first in seg_ends:
-    #     # Append current segment to end of existing one
-    #     segments[seg_ends[first]] += geom[1:]
-    #     seg_ends[last] = seg_ends[first]
-    #     del seg_ends[first]
-    # elif last in seg_ends:
-    #     # Append current segment to beginning of existing one
-    #     segments[seg_ends[last]] += geom[:-1]
-    #     seg_ends[first] = seg_ends[last]
-    #     del seg_ends[last]
-    # else:
-    #     # Create new segment
-    #     segments.append(geom)
-    #     seg_ends[last] = len(segments) - 1
-    #     seg_ends[first] = len(segments) - 1
-    return segments
+    # Joins segments (usually member ways of relation) that share end nodes into longest possible
+    # polylines, reversing them where needed. Closed rings stop growing once they are closed.
+    # End nodes are indexed in dict, so that each segment is looked at only few times.
+    # For russia, around 4000 ways became 34 segments.
+    ends = defaultdict(list)  # (lat, lon) -> numbers of segments starting or ending there
+    for seg_num in range(len(segments)):
+        if len(segments[seg_num]) > 1:
+            ends[segments[seg_num][0]].append(seg_num)
+            ends[segments[seg_num][-1]].append(seg_num)
+    used = [False] * len(segments)
+
+    def take(point: Tuple[float, float]) -> Optional[List[Tuple[float, float]]]:
+        # Returns unused segment that starts or ends at point, turned to start from point.
+        candidates = ends.get(point, [])
+        while candidates:
+            seg_num = candidates.pop()
+            if not used[seg_num]:
+                used[seg_num] = True
+                segment = segments[seg_num]
+                return segment if segment[0] == point else segment[::-1]
+        return None
+
+    merged = []
+    for seg_num in range(len(segments)):
+        if used[seg_num]:
+            continue
+        used[seg_num] = True
+        chain = list(segments[seg_num])
+        if len(chain) < 2:  # Single nodes stay as they are.
+            merged.append(chain)
+            continue
+        # Adding elements is faster at end of list, so first grow forward...
+        while chain[-1] != chain[0]:
+            segment = take(chain[-1])
+            if segment is None:
+                break
+            chain += segment[1:]
+        # ...and then collect pieces that go before the beginning.
+        head = []
+        start = chain[0]
+        while start != chain[-1]:
+            segment = take(start)
+            if segment is None:
+                break
+            head.append(segment[:0:-1])  # Reversed, without the shared node.
+            start = segment[-1]
+        merged.append([point for piece in reversed(head) for point in piece] + chain)
+    return merged
+
+
+def _bounds_to_segment(bounds: Tuple[float, float, float, float]) -> List[Tuple[float, float]]:
+    # Outline of (min_lat, max_lat, min_lon, max_lon) bounding box.
+    min_lat, max_lat, min_lon, max_lon = bounds
+    return [(min_lat, min_lon), (min_lat, max_lon), (max_lat, max_lon), (max_lat, min_lon), (min_lat, min_lon)]
+
+
+async def _query_bounds(elem_type, elem_id, status_msg: Optional[Message] = None):
+    # First phase of fetching relation: bounding box is cheap to get even for huge relations.
+    # Returns (min_lat, max_lat, min_lon, max_lon) or None, if Overpass didn't give it.
+    # This phase is optional, so any Overpass error just means going straight to geometry query.
+    timeout = config["network"]["overpass_bounds_timeout"]
+    Q = f"[out:json][timeout:{timeout}];" + elem_type + "(id:" + str(elem_id) + ");out bb;"
+    if status_msg:
+        await status_msg.edit(content=f"{LOADING_EMOJI} Querying `" + Q + "`")
+    try:
+        result = await network.overpass_query(Q)
+    except overpy.exception.OverPyException:
+        return None
+    if not result.relations or "bounds" not in result.relations[0].attributes:
+        return None
+    bound = result.relations[0].attributes["bounds"]
+    return (float(bound["minlat"]), float(bound["maxlat"]), float(bound["minlon"]), float(bound["maxlon"]))
 
 
 async def elms_to_render(
@@ -587,28 +815,39 @@ async def elms_to_render(
     # Needs handling for Overpass's over quota error.
     # Future improvement possibility: include tags into output to control rendering, especially colours.
     # I have currently odd bug that when get_bbox is fixed to True, all following queries also have bbox.
+    # Relations are fetched in two phases: bounding box first, and then geometry with shorter timeout.
+    # If geometry query fails, already known bounding box is drawn instead of waiting for another query.
 
     get_center = False
+    bounds = None
+    timeout = 45
     if elem_type != "relation":
         get_bbox = False
     elif 1 < recursion_depth:
         get_center = True
+    elif recursion_depth == 0 and not get_bbox:
+        bounds = await _query_bounds(elem_type, elem_id, status_msg)
+        if bounds is not None:
+            # Bounding box is good enough fallback, no point waiting long for geometry.
+            timeout = config["network"]["overpass_geometry_timeout"]
     if get_bbox:
         output_type = "bb"
     elif get_center:
         output_type = "center"
     else:
         output_type = "skel geom"  # Original version
-    Q = "[out:json][timeout:45];" + elem_type + "(id:" + str(elem_id) + ");out " + output_type + ";"
+    Q = f"[out:json][timeout:{timeout}];" + elem_type + "(id:" + str(elem_id) + ");out " + output_type + ";"
     if status_msg:
         await status_msg.edit(
             content=f"{LOADING_EMOJI} Querying `" + Q + "`"
         )  # I hope this works. uncomment on live instance
     # Above line may introduce error when running it from /element, not on_message.
     try:
-        result = overpass_api.query(Q)
-    except exception.OverpassRuntimeError:
+        result = await network.overpass_query(Q)
+    except overpy.exception.OverpassRuntimeError:
         print("Overpass timeout")
+        if bounds is not None:
+            return [_bounds_to_segment(bounds)]
         if not get_bbox:
             # recursion_depth is not increased, because this is retry of same element
             return await elms_to_render(elem_type, elem_id, no_reduction, True, recursion_depth, status_msg=status_msg)
@@ -617,7 +856,7 @@ async def elms_to_render(
             get_center = True
             if status_msg:
                 await status_msg.edit(content=f"{LOADING_EMOJI} Querying `" + Q + "`")
-            result = overpass_api.query(Q)
+            result = await network.overpass_query(Q)
     # return result
     # Since we are querying for single element, top level result will have just 1 element.
     node_count = 0
@@ -632,13 +871,9 @@ async def elms_to_render(
             bound = result.relations[0].attributes["bounds"]
             # {'minlat': Decimal('59.4'), 'minlon': Decimal('24.6'), 'maxlat': Decimal('59.5'), 'maxlon': Decimal('24.7')
             return [
-                [
-                    (float(bound["minlat"]), float(bound["minlon"])),
-                    (float(bound["minlat"]), float(bound["maxlon"])),
-                    (float(bound["maxlat"]), float(bound["maxlon"])),
-                    (float(bound["maxlat"]), float(bound["minlon"])),
-                    (float(bound["minlat"]), float(bound["minlon"])),
-                ]
+                _bounds_to_segment(
+                    (float(bound["minlat"]), float(bound["maxlat"]), float(bound["minlon"]), float(bound["maxlon"]))
+                )
             ]
     if elem_type == "relation":
         segments = []
@@ -669,14 +904,50 @@ async def elms_to_render(
         return []
     if no_reduction:
         return segments
-    # segments=merge_segments(segments)
-    segments = reduce_segment_nodes(segments)
+    # Same way may be member of multiple subrelations, draw it once.
+    segments = list(map(list, dict.fromkeys(map(tuple, segments))))
+    # Whole rings are simplified better and drawn with far fewer draw.line calls.
+    # Nodes are reduced later by reduce_segment_nodes, once zoom level is known.
+    segments = merge_segments(segments)
     # We now have list of lists of (lat, lon) coordinates to be rendered.
     # These lists of segments can be joined, if multiple elements are requested
     # In order to add support for colours, just create segment-colour pairs.
     return segments
 
 
+def calc_preview_area(queue_bounds: Tuple[float, float, float, float]) -> Tuple[int, float, float]:
+    # Input: tuple (min_lat, max_lat, min_lon, max_lon)
+    # Output: tuple (int(zoom), float(lat), float(lon))
+    # Based on old showmap function and https://wiki.openstreetmap.org/wiki/Zoom_levels
+    # Finds map area, that should contain all elements.
+    # I think this function causes issues with incorrect rendering due to using average of boundaries, not tiles.
+    print("Elements bounding box:", *list(map(lambda x: round(x, 4), queue_bounds)))
+    min_lat, max_lat, min_lon, max_lon = queue_bounds
+    delta_lat = max_lat - min_lat
+    delta_lon = max_lon - min_lon
+    zoom_x = int(
+        math.log2((360 / delta_lon) * (config["rendering"]["tiles_x"] - 2 * config["rendering"]["tile_margin_x"]))
+    )
+    center_lon = delta_lon / 2 + min_lon
+    # Zoom level is determined by trying to fit x/y bounds into 5 tiles.
+    zoom_y = config["rendering"]["max_zoom"] + 1
+    while (utils.deg2tile(min_lat, 0, zoom_y)[1] - utils.deg2tile(max_lat, 0, zoom_y)[1] + 1) > config["rendering"][
+        "tiles_y"
+    ] - 2 * config["rendering"]["tile_margin_y"]:
+        zoom_y -= 1  # Bit slow and dumb approach
+    zoom = min(zoom_x, zoom_y, config["rendering"]["max_zoom"])
+    tile_y_min = utils.deg2tile_float(max_lat, 0, zoom)[1]
+    tile_y_max = utils.deg2tile_float(min_lat, 0, zoom)[1]
+    print(zoom, center_lon)
+    if zoom < 10:
+        # At low zoom levels and high latitudes, mercator's distortion must be accounted
+        center_lat = round(utils.tile2deg(zoom, 0, (tile_y_max + tile_y_min) / 2)[0], 5)
+    else:
+        center_lat = (max_lat - min_lat) / 2 + min_lat
+    print(center_lat, min_lat, max_lat)
+    return (zoom, center_lat, center_lon)
+
+
 def get_render_queue_bounds(
     segments: List[List[Tuple[float, float]]], notes: List[Tuple[float, float, bool]] = []
 ) -> Tuple[float, float, float, float]:
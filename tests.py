@@ -1,5 +1,7 @@
 print("Running tests")
-import utils, render
+import asyncio
+
+import cache, utils, render
 from configuration import config
 
 
@@ -43,14 +45,85 @@ def test_7():
     x.add("node", 946092520)  # Museum of the observatory
     x.add("way", 78502673)  # Footway near observatory
     x.add("relation", 9523716)  # Observatory building
-    x.resolve()
+    asyncio.run(x.resolve())
     return x
 
 
+def test_8():
+    lru = cache.LRUCache(max_size=2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1  # "b" is now least recently used
+    lru.set("c", 3)
+    assert "b" not in lru and lru.get("a") == 1 and lru.get("c") == 3
+    lru.set("d", 4, ttl=-1)  # Already expired
+    assert lru.get("d") is None
+    assert (lru.hits, lru.misses) == (3, 1)
+
+
+def test_9():
+    # 5x5 tile fragment needs 5 columns if aligned to tile grid, otherwise 6.
+    assert len(render.get_visible_tiles(10, (100, 103, 100, 103, (0, 0)))) == 25
+    assert len(render.get_visible_tiles(10, (100, 103, 100, 103, (0.5, 0)))) == 30
+    assert len(render.get_visible_tiles(10, (100, 103, 100, 103, (0.5, 0.5)))) == 36
+    # At zoom 1 there are only 2 rows, but columns repeat across -180/180 meridian.
+    tiles = render.get_visible_tiles(1, (-2, 1, -2, 1, (0.5, 0.5)))
+    assert {y for x, y in tiles} == {0, 1}
+    assert len(tiles) == 12
+
+
+def test_10():
+    # Batch projection must place points exactly where per-point projection does.
+    frag = (2, 80.0, -170.0)  # Low zoom and high latitude are the tricky cases.
+    tile_range = render.get_image_tile_range(frag[1], frag[2], frag[0])
+    points = [(80.0, -170.0), (89.5, 10.0), (-89.5, 179.0), (0.0, 0.0), (59.4, 24.7)]
+    batch = utils.wgs2pixel_batch(points, tile_range, frag)
+    assert [tuple(point) for point in batch.tolist()] == [utils.wgs2pixel(p, tile_range, frag) for p in points]
+
+
+def test_11():
+    # Points on straight line are dropped, corners are kept.
+    line = render.np.array([(x, 0.0) for x in range(100)] + [(99.0, y) for y in range(1, 100)])
+    assert render.simplify_segment(line, 0.5).tolist() == [[0.0, 0.0], [99.0, 0.0], [99.0, 99.0]]
+    zigzag = render.np.array([(x, x % 2 * 0.4) for x in range(10)])
+    assert len(render.simplify_segment(zigzag, 0.5)) == 2
+    assert len(render.simplify_segment(zigzag, 0.1)) == 10
+
+
+def test_12():
+    # Three ways of a closed ring (middle one reversed), a separate way and a single node.
+    a, b, c, d, e, f = (0.0, 0.0), (0.0, 1.0), (1.0, 1.0), (1.0, 0.0), (5.0, 5.0), (6.0, 6.0)
+    merged = render.merge_segments([[c, d, a], [a, b], [c, b], [e, f], [e]])
+    assert len(merged) == 3 and [e] in merged and [e, f] in merged
+    ring = next(segment for segment in merged if len(segment) > 2)
+    assert len(ring) == 5 and ring[0] == ring[-1] and set(ring) == {a, b, c, d}
+    # Chain that has to grow in both directions from the first way.
+    assert render.merge_segments([[b, c], [a, b], [d, c]]) == [[a, b, c, d]]
+
+
+def test_13():
+    # Map fragment is 1279x1279 px, clipped here without margin.
+    np = render.np
+    crossing = np.array([(-100.0, 500.0), (500.0, 500.0), (1500.0, 500.0)])
+    assert [s.tolist() for s in render.clip_segments([crossing], 0)] == [[[0, 500], [500, 500], [1279, 500]]]
+    outside = np.array([(-100.0, -100.0), (-50.0, 2000.0)])
+    assert render.clip_segments([outside, np.array([(-5.0, 5.0)])], 0) == []
+    # Leaves the map and comes back, becoming two segments.
+    u_turn = np.array([(100.0, 100.0), (100.0, -100.0), (200.0, -100.0), (200.0, 100.0)])
+    pieces = [s.tolist() for s in render.clip_segments([u_turn], 0)]
+    assert pieces == [[[100, 100], [100, 0]], [[200, 0], [200, 100]]]
+
+
 test_1()
 test_2()
 test_3()
 test_4()
 test_5()
 test_6()
+test_8()
+test_9()
+test_10()
+test_11()
+test_12()
+test_13()
 print(f"All {len(set(filter(lambda x:x[0]!='_', dir())))-1} tests passed.")
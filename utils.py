@@ -1,15 +1,22 @@
 # /bin/python3
 # Utility functions, such as coordinate calculations or data transformations.
+import asyncio
 import math
 import time
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from inspect import getframeinfo
 from inspect import stack
+from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import Optional
 from typing import Tuple
 from typing import Union
 
+import numpy as np
 from discord import Guild
 from discord import Member
 from discord import Message
@@ -132,6 +139,32 @@ def wgs2pixel(
     return tile2pixel(coord, zoom, tile_range)
 
 
+def wgs2pixel_batch(
+    coords,
+    tile_range: Tuple[int, int, int, int, Tuple[float, float]],
+    frag: Tuple[int, float, float],
+) -> np.ndarray:
+    """Convert array of (lat, lon) pairs to X-Y coordinates on map, all at once."""
+    # Same result as calling wgs2pixel for each point, but without per-point Python overhead,
+    # which dominates rendering time for relations with tens of thousands of nodes.
+    zoom = frag[0]
+    n = 2 ** zoom
+    xmin, xmax, ymin, ymax, tile_offset = tile_range
+    if zoom < 3:
+        tile_offset = (tile_offset[0] - 1, tile_offset[1] - 1)  # See tile2pixel
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    lat_deg, lon_deg = coords[:, 0], coords[:, 1]
+    xtile = (lon_deg + 180.0) / 360 * n
+    # Same safety bounds as in deg2tile_float. Clipping only avoids warnings, those rows are replaced anyway.
+    lat_rad = np.radians(np.clip(lat_deg, -89, 89))
+    ytile = (1 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / np.pi) / 2 * n
+    ytile = np.where(lat_deg >= 89, 0, np.where(lat_deg <= -89, n - 1, np.clip(ytile, 0, n)))
+    pixels = np.empty_like(coords)
+    pixels[:, 0] = (xtile - xmin - tile_offset[0]) * config["rendering"]["tile_w"]
+    pixels[:, 1] = (ytile - ymin - tile_offset[1]) * config["rendering"]["tile_h"]
+    return np.round(pixels)
+
+
 def tile2pixel(xy, zoom, tile_range):
     """Convert Z/X/Y tile to map's X-Y coordinates"""
     # That's all, no complex math involved. Rendering bug might be somewhere else.
@@ -210,3 +243,20 @@ def print2(*args, **kwargs):
     kwargs.pop("level")
     print(f"{caller.filename}:{caller.lineno} - ", end="")
     print(*args, **kwargs)
+
+
+# Created on first use by run_in_executor.
+executor: Optional[Executor] = None
+
+
+async def run_in_executor(func: Callable, *args) -> Any:
+    # Runs CPU-heavy function (image decoding, drawing, encoding) in separate thread or process,
+    # so that event loop keeps serving other commands meanwhile. With process pool, arguments and
+    # return value must be picklable and func can't rely on globals set at runtime.
+    global executor
+    if executor is None:
+        if config["rendering"]["executor"] == "process":
+            executor = ProcessPoolExecutor(config["rendering"]["executor_workers"])
+        else:
+            executor = ThreadPoolExecutor(config["rendering"]["executor_workers"], thread_name_prefix="render")
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)